@@ -0,0 +1,132 @@
+import os
+import xbmc
+import xbmcvfs
+from login_service import AudioBookShelfService
+from library_service import AudioBookShelfLibraryService
+from token_store import TokenStore
+from response_cache import ResponseCache
+from progress_queue import ProgressQueue
+from download_manager import DownloadManager
+from stream_proxy import ChunkCache, StreamProxy
+from http_session import get_session
+
+
+def get_credentials(addon):
+	"""Get server credentials from settings"""
+	return {
+		'ip': addon.getSetting('ipaddress'),
+		'port': addon.getSetting('port'),
+		'username': addon.getSetting('username'),
+		'password': addon.getSetting('password')
+	}
+
+
+def is_configured(creds):
+	return all([creds['ip'], creds['port'], creds['username'], creds['password']])
+
+
+def get_int_setting(addon, setting_id, default):
+	"""Read an integer setting, falling back to default if unset or invalid"""
+	try:
+		return int(addon.getSetting(setting_id))
+	except (TypeError, ValueError):
+		return default
+
+
+def get_profile_path(addon):
+	"""Get the addon profile directory"""
+	return xbmcvfs.translatePath(addon.getAddonInfo('profile'))
+
+
+def get_http_session(addon):
+	"""Get the shared pooled HTTP session configured from settings"""
+	return get_session(
+		pool_size=get_int_setting(addon, 'pool_size', 4),
+		timeout=get_int_setting(addon, 'request_timeout', 10),
+		retries=get_int_setting(addon, 'max_retries', 2),
+		backoff=get_int_setting(addon, 'retry_backoff_ms', 500) / 1000.0
+	)
+
+
+def get_response_cache(addon):
+	"""Get the API response cache, or None if disabled in settings"""
+	if addon.getSetting('response_cache') == 'false':
+		return None
+	return ResponseCache(os.path.join(get_profile_path(addon), 'http_cache'))
+
+
+def get_progress_queue(addon):
+	"""Open the local journal of progress updates not yet sent"""
+	return ProgressQueue(os.path.join(get_profile_path(addon), 'progress.db'))
+
+
+def get_download_manager(addon):
+	"""Get the offline download store configured from settings"""
+	return DownloadManager(
+		os.path.join(get_profile_path(addon), 'downloads'),
+		get_http_session(addon),
+		max_workers=get_int_setting(addon, 'download_workers', 2),
+		rate_limit=get_int_setting(addon, 'download_rate_kbps', 0) * 1024,
+		quota_bytes=get_int_setting(addon, 'download_quota_mb', 0) * 1024 * 1024
+	)
+
+
+def create_stream_proxy(addon, get_library_service):
+	"""Build the caching stream proxy, or None if disabled in settings
+
+	get_library_service is called per request so the proxy follows token
+	refreshes and reconnects after settings changes.
+	"""
+	if addon.getSetting('stream_proxy') == 'false':
+		return None
+
+	cache = ChunkCache(
+		os.path.join(get_profile_path(addon), 'stream_cache'),
+		get_int_setting(addon, 'stream_cache_mb', 500) * 1024 * 1024
+	)
+	return StreamProxy(cache, get_http_session(addon), get_library_service)
+
+
+def create_library_service(addon):
+	"""Build a library service from settings, reusing the stored auth token
+
+	Only logs in when no token is stored; a token the server rejects is
+	replaced lazily by the service's first failing request.
+	"""
+	creds = get_credentials(addon)
+	if not is_configured(creds):
+		raise ValueError("Addon is not configured")
+
+	url = f"http://{creds['ip']}:{creds['port']}"
+	token_store = TokenStore(get_profile_path(addon))
+	session = get_http_session(addon)
+
+	def login():
+		"""Log in with the stored credentials and remember the token"""
+		login_service = AudioBookShelfService(url, session=session)
+		response = login_service.login(creds['username'], creds['password'])
+		token = response.get('token')
+
+		if not token:
+			raise ValueError("No token received")
+
+		token_store.save(url, creds['username'], token)
+		return token
+
+	def refresh_token():
+		"""Replace a token the server no longer accepts"""
+		token_store.clear()
+		try:
+			return login()
+		except Exception as e:
+			xbmc.log(f"Re-login failed: {str(e)}", xbmc.LOGERROR)
+			return None
+
+	# Reuse the last token; it is validated lazily by the first API call
+	token = token_store.load(url, creds['username'])
+	if not token:
+		token = login()
+
+	return AudioBookShelfLibraryService(
+		url, token, token_refresher=refresh_token, session=session, cache=get_response_cache(addon)
+	)
@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import threading
+import xbmc
+from concurrent.futures import ThreadPoolExecutor
+
+INDEX_FILE = 'index.json'
+# Untracked covers younger than this may belong to another invocation's unsaved index
+SWEEP_AGE = 3600
+# Last-use times only need to be this accurate for eviction order, so a lookup
+# only forces the index to be rewritten once its recorded use is older
+USE_RESOLUTION = 3600
+
+
+class CoverCache:
+	"""On-disk cover cache with an index, revalidation and LRU eviction
+
+	The index records file name, size, ETag, the item's updatedAt and the last
+	time each cover was used, so lookups never touch the filesystem. Plugin
+	invocations can overlap, so save() merges with the index on disk instead
+	of overwriting it.
+	"""
+
+	def __init__(self, cache_dir, max_bytes):
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+		self.index_path = os.path.join(cache_dir, INDEX_FILE)
+		self.lock = threading.Lock()
+		self.dirty = False
+		# Keys stored or evicted by this instance, for merging on save
+		self.added = set()
+		self.removed = set()
+
+		if not os.path.exists(cache_dir):
+			os.makedirs(cache_dir)
+
+		self.entries = self._load_index()
+		self.total_bytes = sum(entry.get('size', 0) for entry in self.entries.values())
+
+	def _read_index(self):
+		"""Return the entries saved on disk, or None if there is no index"""
+		try:
+			with open(self.index_path, 'r') as f:
+				return json.load(f).get('entries', {})
+		except (OSError, ValueError):
+			return None
+
+	def _load_index(self):
+		"""Read the index and delete cover files it doesn't track"""
+		entries = self._read_index()
+		tracked = set(entry['file'] for entry in (entries or {}).values())
+		now = time.time()
+
+		# Untracked files can't be validated or evicted
+		for name in os.listdir(self.cache_dir):
+			if name == INDEX_FILE or name in tracked:
+				continue
+			if entries is None or now - self._mtime(name) > SWEEP_AGE:
+				self._remove_file(name)
+		return entries or {}
+
+	def _mtime(self, name):
+		try:
+			return os.path.getmtime(os.path.join(self.cache_dir, name))
+		except OSError:
+			return 0
+
+	def _remove_file(self, name):
+		try:
+			os.remove(os.path.join(self.cache_dir, name))
+		except OSError:
+			pass
+
+	def lookup(self, key, version=None):
+		"""Return (path, etag, fresh) for a cached cover, or None if absent"""
+		with self.lock:
+			entry = self.entries.get(key)
+			if not entry:
+				return None
+
+			now = time.time()
+			if now - entry.get('used', 0) >= USE_RESOLUTION:
+				entry['used'] = now
+				self.dirty = True
+			fresh = version is None or entry.get('version') == version
+			return os.path.join(self.cache_dir, entry['file']), entry.get('etag'), fresh
+
+	def mark_fresh(self, key, version):
+		"""Record that the server confirmed a cached cover is current"""
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry:
+				entry['version'] = version
+				entry['used'] = time.time()
+				self.dirty = True
+
+	def store(self, key, data, etag=None, version=None):
+		"""Atomically write a cover and evict old ones beyond the byte budget"""
+		name = f"{key}.jpg"
+		path = os.path.join(self.cache_dir, name)
+		tmp_path = f"{path}.{threading.get_ident()}.part"
+
+		try:
+			with open(tmp_path, 'wb') as f:
+				f.write(data)
+			os.replace(tmp_path, path)
+		except OSError:
+			self._remove_file(os.path.basename(tmp_path))
+			raise
+
+		with self.lock:
+			old = self.entries.get(key)
+			if old:
+				self.total_bytes -= old.get('size', 0)
+
+			self.entries[key] = {
+				'file': name,
+				'size': len(data),
+				'etag': etag,
+				'version': version,
+				'used': time.time()
+			}
+			self.total_bytes += len(data)
+			self.added.add(key)
+			self.removed.discard(key)
+			self.dirty = True
+			self._evict(keep=key)
+
+		return path
+
+	def _evict(self, keep=None):
+		"""Drop least recently used covers until the cache fits its budget"""
+		if self.max_bytes <= 0 or self.total_bytes <= self.max_bytes:
+			return
+
+		for key, entry in sorted(self.entries.items(), key=lambda kv: kv[1].get('used', 0)):
+			if self.total_bytes <= self.max_bytes:
+				break
+			if key == keep:
+				continue
+
+			self._remove_file(entry['file'])
+			self.total_bytes -= entry.get('size', 0)
+			del self.entries[key]
+			self.removed.add(key)
+			self.added.discard(key)
+
+	def _merge_saved(self):
+		"""Fold in entries other invocations saved since this index was loaded"""
+		saved = self._read_index() or {}
+
+		for key, entry in saved.items():
+			if key in self.removed:
+				continue
+			mine = self.entries.get(key)
+			if mine is None or entry.get('used', 0) > mine.get('used', 0):
+				self.entries[key] = entry
+
+		# Covers loaded from disk but no longer saved were evicted elsewhere
+		for key in [key for key in self.entries if key not in saved and key not in self.added]:
+			del self.entries[key]
+
+		self.total_bytes = sum(entry.get('size', 0) for entry in self.entries.values())
+		self._evict()
+
+	def save(self):
+		"""Merge with the index on disk and write it back if anything changed"""
+		with self.lock:
+			if not self.dirty:
+				return
+
+			self._merge_saved()
+
+			tmp_path = self.index_path + '.tmp'
+			try:
+				with open(tmp_path, 'w') as f:
+					json.dump({'entries': self.entries}, f)
+				os.replace(tmp_path, self.index_path)
+				self.dirty = False
+			except OSError as e:
+				xbmc.log(f"Error saving cover index: {str(e)}", xbmc.LOGERROR)
+
+
+class CoverPrefetcher:
+	"""Serve cached covers immediately and download missing ones in the background"""
+
+	def __init__(self, cache, session, max_workers=4):
+		self.cache = cache
+		self.session = session
+		self.executor = ThreadPoolExecutor(max_workers=max_workers)
+		self.in_flight = {}
+		self.lock = threading.Lock()
+
+	def get(self, key, url, version=None):
+		"""Return the cached cover path, or the remote URL while it downloads
+
+		key identifies the cover variant (item and size). version is the item's
+		updatedAt; a cached cover from an older version is still returned but
+		revalidated against the server in the background.
+		"""
+		cached = self.cache.lookup(key, version)
+		if cached:
+			path, etag, fresh = cached
+			if not fresh:
+				self._schedule(key, url, version, etag)
+			return path
+
+		self._schedule(key, url, version)
+
+		# Kodi can load the remote image itself until the local copy exists
+		return url
+
+	def _schedule(self, key, url, version, etag=None):
+		with self.lock:
+			if key not in self.in_flight:
+				self.in_flight[key] = self.executor.submit(self._download, key, url, version, etag)
+
+	def _download(self, key, url, version, etag=None):
+		"""Fetch or revalidate one cover"""
+		try:
+			headers = {'If-None-Match': etag} if etag else None
+			response = self.session.get(url, headers=headers)
+
+			if response.status_code == 304:
+				self.cache.mark_fresh(key, version)
+				return
+
+			response.raise_for_status()
+			self.cache.store(key, response.content, etag=response.headers.get('ETag'), version=version)
+		except Exception as e:
+			xbmc.log(f"Error downloading cover {key}: {str(e)}", xbmc.LOGDEBUG)
+		finally:
+			with self.lock:
+				self.in_flight.pop(key, None)
+
+	def shutdown(self, wait=True):
+		"""Stop accepting work, wait for pending downloads and save the index"""
+		self.executor.shutdown(wait=wait)
+		self.cache.save()
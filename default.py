@@ -4,15 +4,17 @@ import xbmc
 import xbmcgui
 import xbmcaddon
 import xbmcplugin
-import xbmcvfs
 from urllib.parse import urlencode, parse_qsl
-from login_service import AudioBookShelfService
-from library_service import AudioBookShelfLibraryService
-from playback_monitor import PlaybackMonitor, get_resume_position, ask_resume
-try:
-	from urllib.request import urlretrieve
-except ImportError:
-	from urllib import urlretrieve
+import connection
+from library_service import make_listing_record
+from cover_cache import CoverCache, CoverPrefetcher
+from download_manager import QuotaExceeded
+from metadata_index import MetadataIndex, LIBRARIES_KEY, sync_libraries, sync_library, sync_episodes
+from playback_monitor import PlaybackMonitor, ask_resume
+from playback_plan import resolve_playback_plan
+from timeline import get_timeline
+from service_events import PLAY_MESSAGE, is_service_running, notify_service, get_proxy_port
+from stream_proxy import proxy_url
 
 ADDON = xbmcaddon.Addon()
 ADDON_ID = ADDON.getAddonInfo('id')
@@ -27,60 +29,166 @@ def build_url(**kwargs):
 	return f'{ADDON_URL}?{urlencode(kwargs)}'
 
 
-def get_cached_credentials():
-	"""Get server credentials from settings"""
-	return {
-		'ip': ADDON.getSetting('ipaddress'),
-		'port': ADDON.getSetting('port'),
-		'username': ADDON.getSetting('username'),
-		'password': ADDON.getSetting('password')
-	}
+def get_int_setting(setting_id, default):
+	"""Read an integer setting, falling back to default if unset or invalid"""
+	return connection.get_int_setting(ADDON, setting_id, default)
+
+
+def get_profile_path():
+	"""Get the addon profile directory"""
+	return connection.get_profile_path(ADDON)
 
 
 def get_library_service():
 	"""Initialize and return library service"""
-	creds = get_cached_credentials()
+	creds = connection.get_credentials(ADDON)
 	
-	if not all([creds['ip'], creds['port'], creds['username'], creds['password']]):
+	if not connection.is_configured(creds):
 		xbmcgui.Dialog().ok('Configuration Required', 'Please configure the addon settings first.')
 		ADDON.openSettings()
 		return None
 	
-	url = f"http://{creds['ip']}:{creds['port']}"
-	
 	try:
-		login_service = AudioBookShelfService(url)
-		response = login_service.login(creds['username'], creds['password'])
-		token = response.get('token')
-		
-		if not token:
-			raise ValueError("No token received")
-		
-		return AudioBookShelfLibraryService(url, token), url, token
+		library_service = connection.create_library_service(ADDON)
+		return library_service, library_service.base_url, library_service.token
 	except Exception as e:
 		xbmc.log(f"Login failed: {str(e)}", xbmc.LOGERROR)
 		xbmcgui.Dialog().ok('Login Failed', 'Check your server settings and credentials.')
 		return None
 
 
-def download_cover(url, item_id):
-	"""Download cover to cache"""
+def get_download_manager():
+	"""Get the store of files downloaded for offline playback"""
+	return connection.get_download_manager(ADDON)
+
+
+def get_cover_prefetcher(library_service):
+	"""Create the background cover downloader for this invocation"""
+	cache_dir = os.path.join(get_profile_path(), 'covers')
+	cache = CoverCache(cache_dir, get_int_setting('cover_cache_mb', 100) * 1024 * 1024)
+	return CoverPrefetcher(cache, library_service.session, max_workers=get_int_setting('cover_workers', 4))
+
+
+def get_cover_sizes():
+	"""Get the cover widths to request and the art types each one is used for"""
+	return (
+		(get_int_setting('cover_thumb_width', 400), ('thumb', 'poster', 'icon')),
+		(get_int_setting('cover_fanart_width', 1280), ('fanart',))
+	)
+
+
+def get_cover_art(covers, cover_sizes, url, token, record):
+	"""Build the art dict for an item: small covers for lists, a large one for fanart"""
+	item_id = record['id']
+	art = {}
+	
+	for width, art_types in cover_sizes:
+		# The server scales and re-encodes the cover; 0 keeps the original file
+		cover_url = f"{url}/api/items/{item_id}/cover?token={token}"
+		if width > 0:
+			cover_url += f"&width={width}&format=jpeg"
+		
+		# Each size is cached under its own key
+		cover = covers.get(f"{item_id}_{width}", cover_url, version=record['updated_at'])
+		for art_type in art_types:
+			art[art_type] = cover
+	
+	return art
+
+
+def get_metadata_index():
+	"""Open the local library index"""
+	return MetadataIndex(os.path.join(get_profile_path(), 'library.db'))
+
+
+def get_index_sync_interval():
+	"""Get the minimum time between index syncs in seconds"""
+	return get_int_setting('index_sync_interval', 5) * 60
+
+
+def refresh_after_sync(sync):
+	"""Run an index sync after the directory is shown; refresh it if anything changed"""
+	folder_path = ADDON_URL + sys.argv[2]
+	
 	try:
-		profile_path = xbmcvfs.translatePath(ADDON.getAddonInfo('profile'))
-		cache_dir = os.path.join(profile_path, 'covers')
-		
-		if not os.path.exists(cache_dir):
-			os.makedirs(cache_dir)
-		
-		cache_file = os.path.join(cache_dir, f"{item_id}.jpg")
-		
-		if os.path.exists(cache_file):
-			return cache_file
-		
-		urlretrieve(url, cache_file)
-		return cache_file if os.path.exists(cache_file) else None
-	except:
-		return None
+		changed = sync()
+	except Exception as e:
+		# The listing was already served from the index
+		xbmc.log(f"Background index sync failed: {str(e)}", xbmc.LOGINFO)
+		return
+	
+	# Only refresh if the user is still looking at this folder
+	if changed and xbmc.getInfoLabel('Container.FolderPath') == folder_path:
+		xbmc.executebuiltin('Container.Refresh')
+
+
+def add_next_page_item(url_params, page, page_size, total):
+	"""Add a "Next page" folder item linking to url_params"""
+	last_page = (total + page_size - 1) // page_size
+	list_item = xbmcgui.ListItem(label=f'Next page ({page + 2}/{last_page})')
+	list_item.setArt({'icon': 'DefaultFolder.png', 'thumb': 'DefaultFolder.png'})
+	xbmcplugin.addDirectoryItem(ADDON_HANDLE, url_params, list_item, isFolder=True)
+
+
+def get_download_menu(downloads, item_id, episode_id=None):
+	"""Context menu entries to download an item or episode and delete its files"""
+	params = {'item_id': item_id}
+	if episode_id:
+		params['episode_id'] = episode_id
+	
+	menu = [('Download', f"RunPlugin({build_url(action='download', **params)})")]
+	if downloads.is_downloaded(item_id):
+		menu.append(('Delete downloads', f"RunPlugin({build_url(action='delete_download', item_id=item_id)})"))
+	return menu
+
+
+def add_item_entry(record, art, total_items, downloads):
+	"""Add a library item: a folder for podcasts and multi-file books, else playable"""
+	item_id = record['id']
+	title = record['title']
+	
+	list_item = xbmcgui.ListItem(label=title)
+	list_item.setArt(art)
+	list_item.addContextMenuItems(get_download_menu(downloads, item_id))
+	list_item.setInfo('music', {
+		'title': title,
+		'artist': record['author'] or record['narrator'],
+		'album': title,
+		'duration': int(record['duration']),
+		'mediatype': 'song'
+	})
+	
+	# Check if podcast with episodes or multi-file audiobook
+	has_episodes = record['media_type'] == 'podcast' and record['num_episodes'] > 0
+	
+	if has_episodes:
+		# Podcast - list episodes
+		url_params = build_url(action='episodes', item_id=item_id)
+		xbmcplugin.addDirectoryItem(ADDON_HANDLE, url_params, list_item, isFolder=True, totalItems=total_items)
+	elif record['num_files'] > 1:
+		# Multi-file - list parts
+		url_params = build_url(action='parts', item_id=item_id)
+		xbmcplugin.addDirectoryItem(ADDON_HANDLE, url_params, list_item, isFolder=True, totalItems=total_items)
+	else:
+		# Single file - play directly
+		list_item.setProperty('IsPlayable', 'true')
+		url_params = build_url(action='play', item_id=item_id)
+		xbmcplugin.addDirectoryItem(ADDON_HANDLE, url_params, list_item, isFolder=False, totalItems=total_items)
+
+
+def add_episode_entry(item_id, episode_id, title, duration, downloads):
+	"""Add a playable podcast episode"""
+	list_item = xbmcgui.ListItem(label=title)
+	list_item.setProperty('IsPlayable', 'true')
+	list_item.addContextMenuItems(get_download_menu(downloads, item_id, episode_id))
+	list_item.setInfo('music', {
+		'title': title,
+		'duration': int(duration),
+		'mediatype': 'song'
+	})
+	
+	url_params = build_url(action='play_episode', item_id=item_id, episode_id=episode_id)
+	xbmcplugin.addDirectoryItem(ADDON_HANDLE, url_params, list_item, isFolder=False)
 
 
 def list_libraries():
@@ -95,8 +203,14 @@ def list_libraries():
 	library_service, url, token = result
 	
 	try:
-		data = library_service.get_all_libraries()
-		libraries = data.get('libraries', [])
+		index = get_metadata_index()
+		if not index.is_synced(LIBRARIES_KEY):
+			sync_libraries(index, library_service)
+		libraries = index.get_libraries()
+		
+		list_item = xbmcgui.ListItem(label='Search')
+		list_item.setArt({'icon': 'DefaultAddonsSearch.png', 'thumb': 'DefaultAddonsSearch.png'})
+		xbmcplugin.addDirectoryItem(ADDON_HANDLE, build_url(action='search'), list_item, isFolder=True)
 		
 		for library in libraries:
 			list_item = xbmcgui.ListItem(label=library['name'])
@@ -107,14 +221,26 @@ def list_libraries():
 			xbmcplugin.addDirectoryItem(ADDON_HANDLE, url_params, list_item, isFolder=True)
 		
 		xbmcplugin.endOfDirectory(ADDON_HANDLE)
+		
+		if index.sync_due(LIBRARIES_KEY, get_index_sync_interval()):
+			def sync():
+				before = [(library['id'], library['name']) for library in libraries]
+				after = [(library['id'], library['name']) for library in sync_libraries(index, library_service)]
+				return before != after
+			
+			refresh_after_sync(sync)
+		
+		# The root listing is a good moment for housekeeping
+		if library_service.cache:
+			library_service.cache.prune(7 * 24 * 3600)
 	except Exception as e:
 		xbmc.log(f"Error listing libraries: {str(e)}", xbmc.LOGERROR)
 		xbmcgui.Dialog().notification('Error', 'Failed to load libraries', xbmcgui.NOTIFICATION_ERROR)
 		xbmcplugin.endOfDirectory(ADDON_HANDLE, succeeded=False)
 
 
-def list_library_items(library_id):
-	"""List items in a library"""
+def list_library_items(library_id, page=0):
+	"""List items in a library, one page at a time"""
 	xbmcplugin.setContent(ADDON_HANDLE, 'songs')
 	
 	result = get_library_service()
@@ -125,69 +251,63 @@ def list_library_items(library_id):
 	library_service, url, token = result
 	
 	try:
-		items = library_service.get_library_items(library_id)
+		page_size = get_int_setting('page_size', 100)
+		index = get_metadata_index()
+		indexed = index.is_synced(library_id)
 		
-		for item in items.get('results', []):
-			media = item.get('media', {})
-			metadata = item.get('media', {}).get('metadata', {})
-			media_type = item.get('mediaType', 'book')
-			item_id = item['id']
-			
-			# Download cover
-			cover_url = f"{url}/api/items/{item_id}/cover?token={token}"
-			local_cover = download_cover(cover_url, item_id)
-			
-			if not local_cover:
-				local_cover = os.path.join(ADDON_PATH, 'resources', 'icon.png')
-			
-			title = metadata.get('title', 'Unknown')
-			author = metadata.get('authorName', '')
-			narrator = metadata.get('narratorName', '')
-			duration = media.get('duration', 0)
-			
-			list_item = xbmcgui.ListItem(label=title)
-			list_item.setArt({
-				'thumb': local_cover,
-				'poster': local_cover,
-				'fanart': local_cover,
-				'icon': local_cover
-			})
-			
-			list_item.setInfo('music', {
-				'title': title,
-				'artist': author or narrator,
-				'album': title,
-				'duration': int(duration),
-				'mediatype': 'song'
-			})
-			
-			# Check if podcast with episodes or multi-file audiobook
-			has_episodes = media_type == 'podcast' and media.get('numEpisodes', 0) > 0
-			num_files = media.get('numAudioFiles', 1)
-			
-			if has_episodes:
-				# Podcast - list episodes
-				url_params = build_url(action='episodes', item_id=item_id)
-				xbmcplugin.addDirectoryItem(ADDON_HANDLE, url_params, list_item, isFolder=True)
-			elif num_files > 1:
-				# Multi-file - list parts
-				url_params = build_url(action='parts', item_id=item_id)
-				xbmcplugin.addDirectoryItem(ADDON_HANDLE, url_params, list_item, isFolder=True)
-			else:
-				# Single file - play directly
-				list_item.setProperty('IsPlayable', 'true')
-				url_params = build_url(action='play', item_id=item_id)
-				xbmcplugin.addDirectoryItem(ADDON_HANDLE, url_params, list_item, isFolder=False)
+		if indexed:
+			results = index.get_items(library_id, limit=page_size, offset=page * page_size)
+			total = index.count_items(library_id)
+		else:
+			# First visit: serve this page from the server while the index is built.
+			# Listings only need a few fields, so request the minified representation
+			pages = library_service.iter_library_item_pages(
+				library_id, page_size=page_size, start_page=page,
+				sort='media.metadata.title', minified=1
+			)
+			data = next(pages, {})
+			results = [make_listing_record(item) for item in data.get('results', [])]
+			total = data.get('total', len(results))
+		
+		covers = get_cover_prefetcher(library_service)
+		cover_sizes = get_cover_sizes()
+		downloads = get_download_manager()
+		
+		for record in results:
+			# Cached covers, or the remote ones while they download in the background
+			art = get_cover_art(covers, cover_sizes, url, library_service.token, record)
+			add_item_entry(record, art, len(results), downloads)
+		
+		# Link to the next page if the server has more items
+		if page_size > 0 and (page + 1) * page_size < total:
+			add_next_page_item(build_url(action='library', library_id=library_id, page=page + 1), page, page_size, total)
 		
 		xbmcplugin.endOfDirectory(ADDON_HANDLE)
+		
+		# Bring the index up to date after the directory is already shown. The
+		# service keeps indexed libraries current itself
+		if index.sync_due(library_id, get_index_sync_interval()) and not (indexed and is_service_running()):
+			def sync():
+				changed = sync_library(index, library_service, library_id, page_size)
+				# A first visit was listed from the server and needs no refresh
+				return indexed and changed
+			
+			refresh_after_sync(sync)
+		
+		# Finish filling the cache as well
+		covers.shutdown(wait=True)
 	except Exception as e:
 		xbmc.log(f"Error listing items: {str(e)}", xbmc.LOGERROR)
 		xbmcgui.Dialog().notification('Error', 'Failed to load items', xbmcgui.NOTIFICATION_ERROR)
 		xbmcplugin.endOfDirectory(ADDON_HANDLE, succeeded=False)
 
 
-def list_episodes(item_id):
-	"""List podcast episodes"""
+def list_episodes(item_id, page=0):
+	"""List podcast episodes newest first, one page at a time
+
+	Episodes are fetched and sorted once and kept in the local index; pages
+	are served from there until the podcast changes on the server.
+	"""
 	xbmcplugin.setContent(ADDON_HANDLE, 'episodes')
 	
 	result = get_library_service()
@@ -198,37 +318,20 @@ def list_episodes(item_id):
 	library_service, url, token = result
 	
 	try:
-		item = library_service.get_library_item_by_id(item_id, expanded=1)
-		episodes = item.get('media', {}).get('episodes', [])
-		
-		# Sort episodes
-		def get_sort_key(ep):
-			if ep.get('index') is not None:
-				return (0, ep.get('index'))
-			elif ep.get('episode') is not None:
-				return (1, ep.get('episode'))
-			elif ep.get('publishedAt'):
-				return (2, ep.get('publishedAt'))
-			else:
-				return (3, ep.get('title', ''))
-		
-		episodes = sorted(episodes, key=get_sort_key, reverse=True)
+		page_size = get_int_setting('episode_page_size', 50)
+		downloads = get_download_manager()
+		index = get_metadata_index()
+		if not index.episodes_fresh(item_id, get_index_sync_interval()):
+			sync_episodes(index, library_service, item_id)
+		
+		episodes = index.get_episodes(item_id, limit=page_size, offset=page * page_size)
+		total = index.count_episodes(item_id)
 		
 		for episode in episodes:
-			title = episode.get('title', 'Unknown Episode')
-			episode_id = episode.get('id')
-			duration = episode.get('duration', 0)
-			
-			list_item = xbmcgui.ListItem(label=title)
-			list_item.setProperty('IsPlayable', 'true')
-			list_item.setInfo('music', {
-				'title': title,
-				'duration': int(duration),
-				'mediatype': 'song'
-			})
-			
-			url_params = build_url(action='play_episode', item_id=item_id, episode_id=episode_id)
-			xbmcplugin.addDirectoryItem(ADDON_HANDLE, url_params, list_item, isFolder=False)
+			add_episode_entry(item_id, episode['id'], episode['title'], episode['duration'] or 0, downloads)
+		
+		if page_size > 0 and (page + 1) * page_size < total:
+			add_next_page_item(build_url(action='episodes', item_id=item_id, page=page + 1), page, page_size, total)
 		
 		xbmcplugin.endOfDirectory(ADDON_HANDLE)
 	except Exception as e:
@@ -237,6 +340,67 @@ def list_episodes(item_id):
 		xbmcplugin.endOfDirectory(ADDON_HANDLE, succeeded=False)
 
 
+def search(query=None):
+	"""Search titles, authors, narrators, series and episode titles
+
+	Indexed libraries are searched locally; libraries that were never
+	browsed are not indexed yet and are searched on the server instead.
+	"""
+	xbmcplugin.setContent(ADDON_HANDLE, 'songs')
+	
+	if query is None:
+		query = xbmcgui.Dialog().input('Search')
+		xbmcplugin.endOfDirectory(ADDON_HANDLE, succeeded=False)
+		if query:
+			# Carry the query in the folder URL so going back shows the same results
+			xbmc.executebuiltin(f"Container.Update({build_url(action='search', query=query)},replace)")
+		return
+	
+	if not query:
+		xbmcplugin.endOfDirectory(ADDON_HANDLE, succeeded=False)
+		return
+	
+	result = get_library_service()
+	if not result:
+		xbmcplugin.endOfDirectory(ADDON_HANDLE, succeeded=False)
+		return
+	
+	library_service, url, token = result
+	
+	try:
+		index = get_metadata_index()
+		if not index.is_synced(LIBRARIES_KEY):
+			sync_libraries(index, library_service)
+		
+		records, episodes = index.search(query)
+		for library in index.get_libraries():
+			if not index.is_synced(library['id']):
+				records += [make_listing_record(item) for item in library_service.search_library(library['id'], query)]
+		
+		covers = get_cover_prefetcher(library_service)
+		cover_sizes = get_cover_sizes()
+		downloads = get_download_manager()
+		
+		for record in records:
+			art = get_cover_art(covers, cover_sizes, url, library_service.token, record)
+			add_item_entry(record, art, len(records) + len(episodes), downloads)
+		
+		for episode in episodes:
+			title = episode['title']
+			if episode['item_title']:
+				title = f"{episode['item_title']}: {title}"
+			add_episode_entry(episode['item_id'], episode['id'], title, episode['duration'] or 0, downloads)
+		
+		# Results depend on the index, which keeps changing
+		xbmcplugin.endOfDirectory(ADDON_HANDLE, cacheToDisc=False)
+		
+		covers.shutdown(wait=True)
+	except Exception as e:
+		xbmc.log(f"Error searching: {str(e)}", xbmc.LOGERROR)
+		xbmcgui.Dialog().notification('Error', 'Search failed', xbmcgui.NOTIFICATION_ERROR)
+		xbmcplugin.endOfDirectory(ADDON_HANDLE, succeeded=False)
+
+
 def list_parts(item_id):
 	"""List audiobook parts/chapters"""
 	xbmcplugin.setContent(ADDON_HANDLE, 'songs')
@@ -250,13 +414,21 @@ def list_parts(item_id):
 	
 	try:
 		item = library_service.get_library_item_by_id(item_id)
-		audio_files = item.get('media', {}).get('audioFiles', [])
-		chapters = item.get('media', {}).get('chapters', [])
+		timeline = get_timeline(item)
+		audio_files = timeline.files
+		chapters = timeline.chapters
+		
+		if len(audio_files) > 1:
+			# Queue all files at once so Kodi plays through without coming back here
+			list_item = xbmcgui.ListItem(label='Play whole book')
+			list_item.setInfo('music', {
+				'title': item.get('media', {}).get('metadata', {}).get('title', 'Unknown'),
+				'duration': int(item.get('media', {}).get('duration', 0))
+			})
+			xbmcplugin.addDirectoryItem(ADDON_HANDLE, build_url(action='play_book', item_id=item_id), list_item, isFolder=False)
 		
 		if chapters and len(chapters) > 0:
 			# Show chapters
-			chapters = sorted(chapters, key=lambda x: x.get('start', 0))
-			
 			for i, chapter in enumerate(chapters):
 				title = chapter.get('title', f'Chapter {i+1}')
 				start = chapter.get('start', 0)
@@ -271,12 +443,10 @@ def list_parts(item_id):
 					'tracknumber': i + 1
 				})
 				
-				url_params = build_url(action='play_chapter', item_id=item_id, chapter_start=int(start))
+				url_params = build_url(action='play_chapter', item_id=item_id, chapter_start=start)
 				xbmcplugin.addDirectoryItem(ADDON_HANDLE, url_params, list_item, isFolder=False)
 		else:
 			# Show audio files
-			audio_files = sorted(audio_files, key=lambda x: x.get('index', 0))
-			
 			for i, audio_file in enumerate(audio_files):
 				metadata = audio_file.get('metadata', {})
 				title = metadata.get('title') or metadata.get('filename', f'Part {i+1}')
@@ -301,6 +471,116 @@ def list_parts(item_id):
 		xbmcplugin.endOfDirectory(ADDON_HANDLE, succeeded=False)
 
 
+def set_start_offset(list_item, seconds):
+	"""Have Kodi open the stream at a position instead of seeking after start"""
+	if seconds > 0:
+		list_item.setProperty('StartOffset', str(seconds))
+
+
+def build_book_playlist(plan, start_index):
+	"""Queue every file of a book in Kodi's music playlist, in index order
+
+	The file playback starts with opens directly at the plan's seek position.
+	"""
+	playlist = xbmc.PlayList(xbmc.PLAYLIST_MUSIC)
+	playlist.clear()
+	
+	for i, (audio_file, (file_url, offset)) in enumerate(zip(plan.audio_files, plan.tracks)):
+		metadata = audio_file.get('metadata', {})
+		title = metadata.get('title') or metadata.get('filename', f'Part {i+1}')
+		
+		list_item = xbmcgui.ListItem(label=title, path=file_url)
+		list_item.setInfo('music', {
+			'title': title,
+			'album': plan.title,
+			'duration': int(audio_file.get('duration', 0)),
+			'tracknumber': i + 1
+		})
+		if i == start_index:
+			set_start_offset(list_item, plan.seek_position)
+		playlist.add(file_url, list_item)
+	
+	return playlist
+
+
+def start_playback(library_service, plan, as_playlist=False):
+	"""Hand a resolved plan to Kodi and have its progress synced
+
+	If the background service is running it takes over monitoring and this
+	invocation returns right away; otherwise playback is monitored here until
+	it ends. With as_playlist, all files of the book are queued so Kodi moves
+	from file to file by itself under one monitor and session.
+	"""
+	# Stream through the service's caching proxy when it runs
+	port = get_proxy_port()
+	if port:
+		plan.url = proxy_url(plan.url, library_service.base_url, port)
+		plan.tracks = [(proxy_url(track_url, library_service.base_url, port), offset) for track_url, offset in plan.tracks]
+	
+	tracks = plan.tracks if as_playlist else None
+	# Episodes are also marked as watched in Kodi
+	event = {
+		'item_id': plan.item_id,
+		'episode_id': plan.episode_id,
+		'duration': plan.duration,
+		'sync_kodi_watched': bool(plan.episode_id),
+		'episode_title': plan.title if plan.episode_id else None,
+		'session_id': plan.session_id,
+		'url': plan.url,
+		'file_offset': plan.file_offset,
+		'tracks': tracks,
+		'title': plan.title,
+		# Only what the monitor needs to tell which chapter is playing
+		'chapters': [{'start': c.get('start', 0), 'title': c.get('title')} for c in plan.chapters],
+		'start_position': plan.start_position
+	}
+	
+	monitor = None
+	if is_service_running():
+		# Notify first so the service sees the player's start callback
+		notify_service(ADDON_ID, PLAY_MESSAGE, event)
+	else:
+		monitor = PlaybackMonitor(
+			library_service, plan.item_id, plan.duration,
+			episode_id=event['episode_id'],
+			sync_kodi_watched=event['sync_kodi_watched'],
+			episode_title=event['episode_title'],
+			session_id=plan.session_id,
+			url=plan.url,
+			file_offset=plan.file_offset,
+			tracks=tracks,
+			timeline=plan.timeline,
+			title=plan.title,
+			progress_queue=connection.get_progress_queue(ADDON),
+			min_sync_interval=get_int_setting('sync_interval_min', 10),
+			max_sync_interval=get_int_setting('sync_interval_max', 60)
+		)
+		monitor.start_monitoring(plan.start_position)
+	
+	if tracks:
+		start_index = [url for url, offset in tracks].index(plan.url)
+		xbmc.Player().play(build_book_playlist(plan, start_index), startpos=start_index)
+	else:
+		# Create list item
+		list_item = xbmcgui.ListItem(path=plan.url)
+		list_item.setInfo('music', {'title': plan.title, 'duration': int(plan.duration)})
+		set_start_offset(list_item, plan.seek_position)
+		
+		# Set resolved URL
+		xbmcplugin.setResolvedUrl(ADDON_HANDLE, True, list_item)
+	
+	# Syncs until playback stops
+	if monitor:
+		monitor.run()
+
+
+def ask_start_position(resume_position, duration):
+	"""Ask whether to resume from the saved position; returns where to start"""
+	if ask_resume(resume_position, duration):
+		return resume_position
+	return 0
+
+
 def play_item(item_id):
 	"""Play a single-file audiobook"""
 	result = get_library_service()
@@ -310,50 +590,33 @@ def play_item(item_id):
 	library_service, url, token = result
 	
 	try:
-		item = library_service.get_library_item_by_id(item_id)
-		duration = item.get('media', {}).get('duration', 0)
-		title = item.get('media', {}).get('metadata', {}).get('title', 'Unknown')
-		
-		# Get resume position
-		resume_pos = get_resume_position(library_service, item_id)
-		start_position = 0
-		
-		if resume_pos > 0 and ask_resume(resume_pos, duration):
-			start_position = resume_pos
-		
-		# Get play URL
-		play_url = library_service.get_file_url(item_id)
-		
-		# Create list item
-		list_item = xbmcgui.ListItem(path=play_url)
-		list_item.setInfo('music', {'title': title, 'duration': int(duration)})
-		
-		# Set resolved URL
-		xbmcplugin.setResolvedUrl(ADDON_HANDLE, True, list_item)
-		
-		# Wait for playback and monitor
-		xbmc.sleep(1000)
-		player = xbmc.Player()
-		
-		if start_position > 0 and player.isPlaying():
-			xbmc.sleep(1000)
-			player.seekTime(start_position)
-		
-		# Start monitoring
-		monitor = PlaybackMonitor(library_service, item_id, duration)
-		monitor.start_monitoring(start_position)
-		
-		# Wait for playback
-		while player.isPlayingAudio():
-			xbmc.sleep(1000)
-		
-		monitor.stop_monitoring()
+		plan = resolve_playback_plan(library_service, item_id, choose_start=ask_start_position, downloads=get_download_manager())
+		start_playback(library_service, plan)
 		
 	except Exception as e:
 		xbmc.log(f"Error playing item: {str(e)}", xbmc.LOGERROR)
 		xbmcgui.Dialog().notification('Error', 'Playback failed', xbmcgui.NOTIFICATION_ERROR)
 
 
+def play_book(item_id):
+	"""Play all files of a multi-file audiobook as one playlist"""
+	result = get_library_service()
+	if not result:
+		return
+	
+	library_service, url, token = result
+	
+	try:
+		plan = resolve_playback_plan(library_service, item_id, choose_start=ask_start_position, downloads=get_download_manager())
+		if not plan.tracks:
+			raise ValueError("No audio files to queue")
+		start_playback(library_service, plan, as_playlist=True)
+		
+	except Exception as e:
+		xbmc.log(f"Error playing book: {str(e)}", xbmc.LOGERROR)
+		xbmcgui.Dialog().notification('Error', 'Playback failed', xbmcgui.NOTIFICATION_ERROR)
+
+
 def play_episode(item_id, episode_id):
 	"""Play a podcast episode"""
 	result = get_library_service()
@@ -363,59 +626,8 @@ def play_episode(item_id, episode_id):
 	library_service, url, token = result
 	
 	try:
-		item = library_service.get_library_item_by_id(item_id, expanded=1, episode=episode_id)
-		episodes = item.get('media', {}).get('episodes', [])
-		
-		episode = None
-		for ep in episodes:
-			if ep.get('id') == episode_id:
-				episode = ep
-				break
-		
-		if not episode:
-			raise ValueError("Episode not found")
-		
-		title = episode.get('title', 'Unknown')
-		duration = episode.get('duration', 0)
-		
-		# Get resume position
-		resume_pos = get_resume_position(library_service, item_id, episode_id)
-		start_position = 0
-		
-		if resume_pos > 0 and ask_resume(resume_pos, duration):
-			start_position = resume_pos
-		
-		# Get play URL
-		play_url = library_service.get_file_url(item_id, episode_id=episode_id)
-		
-		# Create list item
-		list_item = xbmcgui.ListItem(path=play_url)
-		list_item.setInfo('music', {'title': title, 'duration': int(duration)})
-		
-		# Set resolved URL
-		xbmcplugin.setResolvedUrl(ADDON_HANDLE, True, list_item)
-		
-		# Wait and monitor
-		xbmc.sleep(1000)
-		player = xbmc.Player()
-		
-		if start_position > 0 and player.isPlaying():
-			xbmc.sleep(1000)
-			player.seekTime(start_position)
-		
-		# Start monitoring with Kodi sync
-		monitor = PlaybackMonitor(
-			library_service, item_id, duration,
-			episode_id=episode_id,
-			sync_kodi_watched=True,
-			episode_title=title
-		)
-		monitor.start_monitoring(start_position)
-		
-		while player.isPlayingAudio():
-			xbmc.sleep(1000)
-		
-		monitor.stop_monitoring()
+		plan = resolve_playback_plan(library_service, item_id, episode_id=episode_id, choose_start=ask_start_position, downloads=get_download_manager())
+		start_playback(library_service, plan)
 		
 	except Exception as e:
 		xbmc.log(f"Error playing episode: {str(e)}", xbmc.LOGERROR)
@@ -431,58 +643,8 @@ def play_chapter(item_id, chapter_start):
 	library_service, url, token = result
 	
 	try:
-		item = library_service.get_library_item_by_id(item_id)
-		audio_files = item.get('media', {}).get('audioFiles', [])
-		duration = item.get('media', {}).get('duration', 0)
-		
-		# Find correct file for chapter start
-		sorted_files = sorted(audio_files, key=lambda x: x.get('index', 0))
-		cumulative = 0
-		target_file = None
-		seek_position = chapter_start
-		
-		for f in sorted_files:
-			file_duration = f.get('duration', 0)
-			if cumulative <= chapter_start < cumulative + file_duration:
-				target_file = f
-				seek_position = chapter_start - cumulative
-				break
-			cumulative += file_duration
-		
-		if not target_file:
-			target_file = sorted_files[-1] if sorted_files else None
-		
-		if not target_file:
-			raise ValueError("Could not find audio file")
-		
-		# Get play URL
-		ino = target_file.get('ino')
-		play_url = f"{url}/api/items/{item_id}/file/{ino}?token={token}"
-		
-		# Create list item
-		title = item.get('media', {}).get('metadata', {}).get('title', 'Unknown')
-		list_item = xbmcgui.ListItem(path=play_url)
-		list_item.setInfo('music', {'title': title, 'duration': int(duration)})
-		
-		# Set resolved URL
-		xbmcplugin.setResolvedUrl(ADDON_HANDLE, True, list_item)
-		
-		# Wait and seek
-		xbmc.sleep(1000)
-		player = xbmc.Player()
-		
-		if seek_position > 0 and player.isPlaying():
-			xbmc.sleep(1000)
-			player.seekTime(seek_position)
-		
-		# Monitor with absolute time
-		monitor = PlaybackMonitor(library_service, item_id, duration)
-		monitor.start_monitoring(chapter_start)
-		
-		while player.isPlayingAudio():
-			xbmc.sleep(1000)
-		
-		monitor.stop_monitoring()
+		plan = resolve_playback_plan(library_service, item_id, chapter_start=chapter_start, with_resume=False, downloads=get_download_manager())
+		start_playback(library_service, plan)
 		
 	except Exception as e:
 		xbmc.log(f"Error playing chapter: {str(e)}", xbmc.LOGERROR)
@@ -498,48 +660,62 @@ def play_file(item_id, file_ino):
 	library_service, url, token = result
 	
 	try:
-		item = library_service.get_library_item_by_id(item_id)
-		audio_files = item.get('media', {}).get('audioFiles', [])
-		duration = item.get('media', {}).get('duration', 0)
-		
-		# Find file by ino
-		target_file = None
-		for f in audio_files:
-			if f.get('ino') == file_ino:
-				target_file = f
-				break
-		
-		if not target_file:
-			raise ValueError("File not found")
-		
-		# Get play URL
-		play_url = f"{url}/api/items/{item_id}/file/{file_ino}?token={token}"
-		
-		# Create list item
-		title = item.get('media', {}).get('metadata', {}).get('title', 'Unknown')
-		list_item = xbmcgui.ListItem(path=play_url)
-		list_item.setInfo('music', {'title': title, 'duration': int(duration)})
-		
-		# Set resolved URL
-		xbmcplugin.setResolvedUrl(ADDON_HANDLE, True, list_item)
-		
-		# Monitor
-		xbmc.sleep(1000)
-		player = xbmc.Player()
-		
-		monitor = PlaybackMonitor(library_service, item_id, duration)
-		monitor.start_monitoring(0)
-		
-		while player.isPlayingAudio():
-			xbmc.sleep(1000)
-		
-		monitor.stop_monitoring()
+		plan = resolve_playback_plan(library_service, item_id, file_ino=file_ino, with_resume=False, downloads=get_download_manager())
+		start_playback(library_service, plan)
 		
 	except Exception as e:
 		xbmc.log(f"Error playing file: {str(e)}", xbmc.LOGERROR)
 		xbmcgui.Dialog().notification('Error', 'Playback failed', xbmcgui.NOTIFICATION_ERROR)
 
 
+def download(item_id, episode_id=None):
+	"""Download an item's audio files, or one episode, for offline playback"""
+	result = get_library_service()
+	if not result:
+		return
+	
+	library_service, url, token = result
+	downloads = get_download_manager()
+	kodi_monitor = xbmc.Monitor()
+	dialog = xbmcgui.DialogProgressBG()
+	dialog.create('Downloading', '')
+	percent = [-1]
+	
+	def progress(done, total):
+		# Called for every chunk from several threads; only redraw on change
+		current = int(done * 100 / total) if total else 0
+		if current != percent[0]:
+			percent[0] = current
+			dialog.update(current)
+	
+	try:
+		failed = downloads.download_item(
+			library_service, item_id,
+			episode_ids=[episode_id] if episode_id else None,
+			progress=progress,
+			should_stop=kodi_monitor.abortRequested
+		)
+		if failed:
+			xbmcgui.Dialog().notification('Download', f'{failed} file(s) failed, try again to resume', xbmcgui.NOTIFICATION_WARNING)
+		else:
+			xbmcgui.Dialog().notification('Download', 'Download complete', xbmcgui.NOTIFICATION_INFO)
+	except QuotaExceeded as e:
+		xbmc.log(f"Download refused: {str(e)}", xbmc.LOGINFO)
+		xbmcgui.Dialog().notification('Download', 'Not enough download space', xbmcgui.NOTIFICATION_ERROR)
+	except Exception as e:
+		xbmc.log(f"Error downloading: {str(e)}", xbmc.LOGERROR)
+		xbmcgui.Dialog().notification('Error', 'Download failed', xbmcgui.NOTIFICATION_ERROR)
+	finally:
+		dialog.close()
+
+
+def delete_download(item_id):
+	"""Remove an item's downloaded files"""
+	get_download_manager().delete_item(item_id)
+	xbmcgui.Dialog().notification('Download', 'Downloads deleted', xbmcgui.NOTIFICATION_INFO)
+	xbmc.executebuiltin('Container.Refresh')
+
+
 def router(paramstring):
 	"""Route to appropriate function"""
 	params = dict(parse_qsl(paramstring))
@@ -550,17 +726,25 @@ def router(paramstring):
 		action = params.get('action')
 		
 		if action == 'library':
-			list_library_items(params['library_id'])
+			list_library_items(params['library_id'], int(params.get('page', 0)))
+		elif action == 'search':
+			search(params.get('query'))
+		elif action == 'download':
+			download(params['item_id'], params.get('episode_id'))
+		elif action == 'delete_download':
+			delete_download(params['item_id'])
 		elif action == 'episodes':
-			list_episodes(params['item_id'])
+			list_episodes(params['item_id'], int(params.get('page', 0)))
 		elif action == 'parts':
 			list_parts(params['item_id'])
 		elif action == 'play':
 			play_item(params['item_id'])
+		elif action == 'play_book':
+			play_book(params['item_id'])
 		elif action == 'play_episode':
 			play_episode(params['item_id'], params['episode_id'])
 		elif action == 'play_chapter':
-			play_chapter(params['item_id'], int(params['chapter_start']))
+			play_chapter(params['item_id'], float(params['chapter_start']))
 		elif action == 'play_file':
 			play_file(params['item_id'], params['file_ino'])
 		else:
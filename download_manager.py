@@ -0,0 +1,193 @@
+import os
+import time
+import shutil
+import threading
+import xbmc
+from concurrent.futures import ThreadPoolExecutor
+
+# Bytes read from the response between writes and rate limiter checks
+CHUNK_SIZE = 256 * 1024
+
+PART_SUFFIX = '.part'
+
+
+class DownloadCancelled(Exception):
+	pass
+
+
+class QuotaExceeded(Exception):
+	"""The files to download don't fit in the download space limit"""
+
+
+class RateLimiter:
+	"""Throttle the combined throughput of all transfers to rate bytes per second"""
+
+	def __init__(self, rate):
+		self.rate = rate
+		self.lock = threading.Lock()
+		self.next_time = time.monotonic()
+
+	def consume(self, size):
+		"""Account for size bytes, sleeping if transfers are ahead of the rate"""
+		if self.rate <= 0:
+			return
+
+		with self.lock:
+			now = time.monotonic()
+			self.next_time = max(self.next_time, now) + size / self.rate
+			delay = self.next_time - now - 1
+		# Allow a one second burst before throttling
+		if delay > 0:
+			time.sleep(delay)
+
+
+class DownloadManager:
+	"""Keep audio files of items in the profile for offline playback
+
+	Files are stored as <root>/<item_id>/<ino><ext>. Data is written to a
+	.part file first and a later attempt continues it with a Range request;
+	the file only gets its final name once its size matches the server's.
+	The server exposes no checksums, so the size is what gets verified.
+	"""
+
+	def __init__(self, root, session, max_workers=2, rate_limit=0, quota_bytes=0):
+		self.root = root
+		self.session = session
+		self.max_workers = max(1, max_workers)
+		self.limiter = RateLimiter(rate_limit)
+		# 0 means unlimited
+		self.quota_bytes = quota_bytes
+
+		if not os.path.exists(root):
+			os.makedirs(root)
+
+	def _file_path(self, item_id, audio_file):
+		ext = audio_file.get('metadata', {}).get('ext') or ''
+		return os.path.join(self.root, item_id, f"{audio_file.get('ino')}{ext}")
+
+	def local_path(self, item_id, audio_file):
+		"""Path of a completely downloaded audio file, or None"""
+		if not audio_file or not audio_file.get('ino'):
+			return None
+		path = self._file_path(item_id, audio_file)
+		return path if os.path.exists(path) else None
+
+	def is_downloaded(self, item_id):
+		"""Whether anything of an item has been downloaded"""
+		return os.path.isdir(os.path.join(self.root, item_id))
+
+	def used_bytes(self):
+		"""Disk space taken by downloads, including partial files"""
+		total = 0
+		for directory, _, names in os.walk(self.root):
+			for name in names:
+				try:
+					total += os.path.getsize(os.path.join(directory, name))
+				except OSError:
+					pass
+		return total
+
+	def delete_item(self, item_id):
+		"""Remove all downloaded files of an item"""
+		shutil.rmtree(os.path.join(self.root, item_id), ignore_errors=True)
+
+	def download_item(self, library_service, item_id, episode_ids=None, progress=None, should_stop=None):
+		"""Download all audio files of an item, or only the given podcast episodes
+
+		Without episode_ids a podcast downloads all of its episodes.
+		progress(done_bytes, total_bytes) is called as data arrives and
+		should_stop() is polled to cancel. Raises QuotaExceeded if the files
+		would not fit in the quota and ValueError if there is nothing to
+		download; returns the number of files that failed.
+		"""
+		item = library_service.get_library_item_by_id(item_id)
+		media = item.get('media', {})
+
+		if episode_ids is not None or item.get('mediaType') == 'podcast':
+			audio_files = [episode.get('audioFile') for episode in media.get('episodes', [])
+						   if (episode_ids is None or episode.get('id') in episode_ids) and episode.get('audioFile')]
+		else:
+			audio_files = media.get('audioFiles', [])
+
+		if not audio_files:
+			raise ValueError("Item has no audio files to download")
+
+		jobs = []
+		for audio_file in audio_files:
+			if not audio_file.get('ino') or self.local_path(item_id, audio_file):
+				continue
+			path = self._file_path(item_id, audio_file)
+			size = audio_file.get('metadata', {}).get('size') or 0
+			jobs.append((library_service.get_direct_file_url(item_id, audio_file['ino']), path, size))
+
+		if not jobs:
+			return 0
+
+		total = sum(size for url, path, size in jobs)
+		have = sum(_part_size(path + PART_SUFFIX) for url, path, size in jobs)
+		if self.quota_bytes > 0 and self.used_bytes() + total - have > self.quota_bytes:
+			raise QuotaExceeded("Download quota exceeded")
+
+		os.makedirs(os.path.dirname(jobs[0][1]), exist_ok=True)
+
+		done = [have]
+		lock = threading.Lock()
+
+		def advance(size):
+			with lock:
+				done[0] += size
+				if progress:
+					progress(done[0], total)
+
+		failed = 0
+		with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+			futures = [pool.submit(self._download_file, url, path, size, advance, should_stop)
+					   for url, path, size in jobs]
+			for future in futures:
+				try:
+					future.result()
+				except DownloadCancelled:
+					failed += 1
+				except Exception as e:
+					xbmc.log(f"Download of {item_id} failed: {str(e)}", xbmc.LOGERROR)
+					failed += 1
+
+		return failed
+
+	def _download_file(self, url, path, expected_size, advance, should_stop):
+		"""Fetch one file, continuing a partial download where it left off"""
+		part_path = path + PART_SUFFIX
+		offset = _part_size(part_path)
+
+		if not expected_size or offset < expected_size:
+			headers = {'Range': f'bytes={offset}-'} if offset else {}
+			with self.session.get(url, headers=headers, stream=True) as response:
+				if offset and response.status_code == 200:
+					# The server ignored the range; start over
+					advance(-offset)
+					offset = 0
+				response.raise_for_status()
+
+				with open(part_path, 'ab' if offset else 'wb') as f:
+					for chunk in response.iter_content(CHUNK_SIZE):
+						if should_stop and should_stop():
+							raise DownloadCancelled()
+						f.write(chunk)
+						advance(len(chunk))
+						self.limiter.consume(len(chunk))
+
+		actual_size = _part_size(part_path)
+		if expected_size and actual_size != expected_size:
+			if actual_size > expected_size:
+				# Can't be continued; the next attempt starts over
+				os.remove(part_path)
+			raise ValueError(f"Size mismatch for {path}: {actual_size} != {expected_size}")
+
+		os.replace(part_path, path)
+
+
+def _part_size(path):
+	try:
+		return os.path.getsize(path)
+	except OSError:
+		return 0
@@ -0,0 +1,65 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+try:
+	from urllib3.util.retry import Retry
+except ImportError:
+	from requests.packages.urllib3.util.retry import Retry
+
+DEFAULT_TIMEOUT = 10
+DEFAULT_POOL_SIZE = 4
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 0.5
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+	"""HTTP adapter that applies a default timeout to every request"""
+
+	def __init__(self, timeout=DEFAULT_TIMEOUT, **kwargs):
+		self.timeout = timeout
+		super().__init__(**kwargs)
+
+	def send(self, request, **kwargs):
+		if kwargs.get('timeout') is None:
+			kwargs['timeout'] = self.timeout
+		return super().send(request, **kwargs)
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+				   retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+	"""Create a pooled keep-alive session with timeouts and retries"""
+	# Only idempotent requests are retried (urllib3's default method list)
+	retry = Retry(
+		total=retries,
+		connect=retries,
+		read=retries,
+		status=retries,
+		backoff_factor=backoff,
+		status_forcelist=(502, 503, 504),
+		raise_on_status=False
+	)
+
+	adapter = TimeoutHTTPAdapter(
+		timeout=timeout,
+		pool_connections=pool_size,
+		pool_maxsize=pool_size,
+		max_retries=retry
+	)
+
+	session = requests.Session()
+	session.mount('http://', adapter)
+	session.mount('https://', adapter)
+	return session
+
+
+def get_session(**kwargs):
+	"""Return the process-wide shared session, creating it on first use"""
+	global _session
+
+	with _session_lock:
+		if _session is None:
+			_session = create_session(**kwargs)
+		return _session
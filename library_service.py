@@ -1,25 +1,142 @@
-import requests
+import threading
 import xbmc
 import json
+from http_session import get_session
+
+def make_listing_record(item):
+	"""Project a library item onto the fields directory listings use
+
+	Minified items carry joined names and counts; expanded ones (e.g. search
+	results) carry the lists they are derived from.
+	"""
+	media = item.get('media', {})
+	metadata = media.get('metadata', {})
+	authors = ', '.join(a.get('name', '') for a in metadata.get('authors') or [])
+	narrators = ', '.join(metadata.get('narrators') or [])
+
+	return {
+		'id': item['id'],
+		'media_type': item.get('mediaType', 'book'),
+		'title': metadata.get('title') or 'Unknown',
+		'sort_title': metadata.get('titleIgnorePrefix') or metadata.get('title') or '',
+		'author': metadata.get('authorName') or metadata.get('author') or authors,
+		'narrator': metadata.get('narratorName') or narrators,
+		'series': metadata.get('seriesName') or '',
+		'duration': media.get('duration') or 0,
+		'num_episodes': media.get('numEpisodes') or len(media.get('episodes') or []),
+		'num_files': media.get('numAudioFiles') or media.get('numTracks') or len(media.get('audioFiles') or []) or 1,
+		'added_at': item.get('addedAt') or 0,
+		'updated_at': item.get('updatedAt') or 0
+	}
+
 
 class AudioBookShelfLibraryService:
 	"""Library service for Audiobookshelf API - Kodi 21 compatible"""
 	
-	def __init__(self, base_url=None, token=None):
-		"""Initialize the library service with base URL and authentication token"""
-		self.token = token
+	def __init__(self, base_url=None, token=None, token_refresher=None, session=None, cache=None):
+		"""Initialize the library service with base URL and authentication token
+
+		token_refresher is called without arguments when the server rejects the
+		current token and must return a fresh one (or None to give up).
+		session defaults to the shared pooled session from http_session.
+		cache is an optional ResponseCache for GET requests.
+		"""
 		self.base_url = base_url
+		self.session = session or get_session()
+		self.cache = cache
+		self._session_items = {}
+		self.token_refresher = token_refresher
+		self._refresh_lock = threading.Lock()
+		self._set_token(token)
+
+	def _set_token(self, token):
+		"""Switch all following requests to a new authentication token"""
+		self.token = token
 		self.headers = {
 			"Content-Type": "application/json",
 			"Authorization": f"Bearer {token}"
 		}
 
+	def refresh_token(self, rejected_token):
+		"""Obtain a new token after the server answered 401; returns whether one is available
+
+		Also used by callers that send their own authenticated requests, such
+		as the stream proxy.
+		"""
+		if not self.token_refresher:
+			return False
+
+		with self._refresh_lock:
+			# Another thread may already have refreshed it
+			if self.token != rejected_token:
+				return True
+
+			xbmc.log("Auth token rejected, logging in again", xbmc.LOGINFO)
+			token = self.token_refresher()
+			if not token:
+				return False
+
+			self._set_token(token)
+			return True
+
+	def _request(self, method, url, headers=None, **kwargs):
+		"""Send a request, re-authenticating once if the token has expired"""
+		token = self.token
+		response = self.session.request(method, url, headers=dict(self.headers, **(headers or {})), **kwargs)
+
+		if response.status_code == 401 and self.refresh_token(token):
+			response = self.session.request(method, url, headers=dict(self.headers, **(headers or {})), **kwargs)
+
+		return response
+
+	def _get_json(self, url, params=None, allow_404=False):
+		"""GET a JSON resource, served from or revalidated against the cache"""
+		cached = self.cache.get(url, params) if self.cache else None
+		headers = None
+		if cached:
+			body, etag, fresh = cached
+			if fresh:
+				return body
+			if etag:
+				headers = {"If-None-Match": etag}
+
+		response = self._request("GET", url, headers=headers, params=params)
+
+		if response.status_code == 304 and cached:
+			self.cache.touch(url, params)
+			return body
+
+		if response.status_code == 404 and allow_404:
+			if cached:
+				self.cache.invalidate(url)
+			return None
+
+		response.raise_for_status()
+		body = response.json()
+		if self.cache:
+			self.cache.put(url, params, body, etag=response.headers.get("ETag"))
+		return body
+
+	def _invalidate(self, endpoint):
+		"""Forget cached responses for an endpoint after writing to it"""
+		if self.cache:
+			self.cache.invalidate(self.base_url + endpoint)
+
+	def _invalidate_progress(self, library_item_id, episode_id=None):
+		endpoint = f"/api/me/progress/{library_item_id}"
+		if episode_id:
+			endpoint += f"/{episode_id}"
+		self._invalidate(endpoint)
+
+	def _invalidate_session_progress(self, session_id):
+		"""Forget cached progress of the item a playback session belongs to"""
+		if session_id in self._session_items:
+			self._invalidate_progress(*self._session_items[session_id])
+
 	def get_all_libraries(self):
 		"""Get all available libraries from the server"""
 		url = f"{self.base_url}/api/libraries"
-		response = requests.get(url, headers=self.headers)
-		response.raise_for_status()
-		return response.json()
+		return self._get_json(url)
 
 	def get_library(self, library_id, include_filterdata=False):
 		"""Get details for a specific library"""
@@ -28,9 +145,7 @@ class AudioBookShelfLibraryService:
 		if include_filterdata:
 			params["include"] = "filterdata"
 		
-		response = requests.get(url, headers=self.headers, params=params)
-		response.raise_for_status()
-		return response.json()
+		return self._get_json(url, params=params)
 
 	def get_library_items(self, library_id, limit=None, page=None, sort=None, desc=None, 
 						  filter=None, minified=None, collapseseries=None, include=None):
@@ -55,9 +170,36 @@ class AudioBookShelfLibraryService:
 		if include is not None:
 			params["include"] = include
 			
-		response = requests.get(url, headers=self.headers, params=params)
-		response.raise_for_status()
-		return response.json()
+		return self._get_json(url, params=params)
+
+	def search_library(self, library_id, query, limit=25):
+		"""Search a library on the server; returns the matching library items"""
+		url = f"{self.base_url}/api/libraries/{library_id}/search"
+		data = self._get_json(url, params={"q": query, "limit": limit}) or {}
+
+		# Results are grouped by media type, each wrapping the library item
+		return [result['libraryItem'] for group in ('book', 'podcast')
+				for result in data.get(group, []) if 'libraryItem' in result]
+
+	def iter_library_item_pages(self, library_id, page_size=100, start_page=0, **kwargs):
+		"""Yield item pages of a library one request at a time
+
+		Each yielded value is the raw page response (results, total, page, limit).
+		Extra keyword arguments are passed through to get_library_items.
+		"""
+		page = start_page
+		while True:
+			data = self.get_library_items(library_id, limit=page_size, page=page, **kwargs)
+			results = data.get('results', [])
+			if not results:
+				return
+
+			yield data
+
+			total = data.get('total', 0)
+			if len(results) < page_size or (page + 1) * page_size >= total:
+				return
+			page += 1
 
 	def get_library_item_by_id(self, item_id, expanded=None, include=None, episode=None):
 		"""Get detailed information about a specific library item"""
@@ -71,9 +213,7 @@ class AudioBookShelfLibraryService:
 		if episode is not None:
 			params["episode"] = episode
 		
-		response = requests.get(url, headers=self.headers, params=params)
-		response.raise_for_status()
-		return response.json()
+		return self._get_json(url, params=params)
 
 	def play_library_item_by_id(self, item_id, episode_id=None, device_info=None, 
 								force_direct_play=False, force_transcode=False, 
@@ -96,15 +236,23 @@ class AudioBookShelfLibraryService:
 		if supported_mime_types:
 			payload["supportedMimeTypes"] = supported_mime_types
 
-		response = requests.post(url, headers=self.headers, json=payload)
+		response = self._request("POST", url, json=payload)
 		response.raise_for_status()
 		return response.json()
 
-	def get_file_url(self, iid, episode_id=None):
-		"""Get the streaming URL for an audiobook file or podcast episode"""
+	def get_direct_file_url(self, iid, ino):
+		"""Get the direct streaming URL of one audio file of an item"""
+		return f"{self.base_url}/api/items/{iid}/file/{ino}?token={self.token}"
+
+	def get_file_url(self, iid, episode_id=None, item=None):
+		"""Get the streaming URL for an audiobook file or podcast episode
+
+		Pass an already fetched item to avoid requesting it again.
+		"""
 		try:
 			# First try to get the item details to find direct file access
-			item = self.get_library_item_by_id(iid, expanded=1 if episode_id else None, episode=episode_id)
+			if item is None:
+				item = self.get_library_item_by_id(iid, expanded=1 if episode_id else None, episode=episode_id)
 			
 			# For podcast episodes
 			if episode_id:
@@ -125,7 +273,7 @@ class AudioBookShelfLibraryService:
 					
 					if ino:
 						# Use direct file streaming endpoint for episode
-						direct_url = f"{self.base_url}/api/items/{iid}/file/{ino}?token={self.token}"
+						direct_url = self.get_direct_file_url(iid, ino)
 						xbmc.log(f"Using direct episode file URL: {direct_url}", xbmc.LOGINFO)
 						return direct_url
 			
@@ -139,7 +287,7 @@ class AudioBookShelfLibraryService:
 					
 					if ino:
 						# Use direct file streaming endpoint
-						direct_url = f"{self.base_url}/api/items/{iid}/file/{ino}?token={self.token}"
+						direct_url = self.get_direct_file_url(iid, ino)
 						xbmc.log(f"Using direct file URL: {direct_url}", xbmc.LOGINFO)
 						return direct_url
 			
@@ -173,25 +321,20 @@ class AudioBookShelfLibraryService:
 			endpoint += f"/{episode_id}"
 
 		try:
-			response = requests.get(self.base_url + endpoint, headers=self.headers)
-			
 			# 404 means no progress saved yet (not an error)
-			if response.status_code == 404:
+			progress = self._get_json(self.base_url + endpoint, allow_404=True)
+			if progress is None:
 				xbmc.log(f"No progress found for item (new item)", xbmc.LOGINFO)
-				return None
-			
-			response.raise_for_status()
-			return response.json()
+			return progress
 		except json.JSONDecodeError:
 			xbmc.log("Failed to decode JSON response for media progress", xbmc.LOGERROR)
-			xbmc.log(response.text, xbmc.LOGDEBUG)
 			return None
 		except Exception as e:
 			xbmc.log(f"Error getting media progress: {str(e)}", xbmc.LOGDEBUG)
 			return None
 
 	def update_media_progress(self, library_item_id, current_time, duration, is_finished=False, episode_id=None):
-		"""Update playback progress on the server"""
+		"""Update playback progress on the server; returns None if it failed"""
 		endpoint = f"/api/me/progress/{library_item_id}"
 		if episode_id:
 			endpoint += f"/{episode_id}"
@@ -204,17 +347,55 @@ class AudioBookShelfLibraryService:
 		}
 		
 		try:
-			response = requests.patch(self.base_url + endpoint, headers=self.headers, json=data)
+			response = self._request("PATCH", self.base_url + endpoint, json=data)
+			self._invalidate(endpoint)
 			response.raise_for_status()
 			xbmc.log(f"Progress updated: {current_time:.1f}s / {duration:.1f}s ({data['progress']*100:.1f}%)", xbmc.LOGINFO)
 			return response.json()
 		except json.JSONDecodeError:
-			xbmc.log("Invalid or empty JSON response received", xbmc.LOGERROR)
-			return None
+			# The server accepted the update but sent no JSON body
+			xbmc.log("Invalid or empty JSON response received", xbmc.LOGDEBUG)
+			return {}
 		except Exception as e:
 			xbmc.log(f"Error updating media progress: {str(e)}", xbmc.LOGERROR)
 			return None
 	
+	def batch_update_media_progress(self, updates):
+		"""Update progress of several items in one request; returns None if it failed
+
+		updates is a list of dicts with library_item_id, current_time, duration,
+		is_finished and optionally episode_id.
+		"""
+		endpoint = "/api/me/progress/batch/update"
+
+		data = []
+		for update in updates:
+			duration = update['duration']
+			entry = {
+				"libraryItemId": update['library_item_id'],
+				"currentTime": update['current_time'],
+				"duration": duration,
+				"isFinished": update.get('is_finished', False),
+				"progress": (update['current_time'] / duration) if duration > 0 else 0
+			}
+			if update.get('episode_id'):
+				entry["episodeId"] = update['episode_id']
+			data.append(entry)
+
+		try:
+			response = self._request("PATCH", self.base_url + endpoint, json=data)
+			for update in updates:
+				self._invalidate_progress(update['library_item_id'], update.get('episode_id'))
+			response.raise_for_status()
+			xbmc.log(f"Progress updated for {len(updates)} item(s)", xbmc.LOGINFO)
+			return response.json()
+		except json.JSONDecodeError:
+			# The server accepted the update but sent no JSON body
+			return {}
+		except Exception as e:
+			xbmc.log(f"Error updating media progress: {str(e)}", xbmc.LOGERROR)
+			return None
+
 	def start_playback_session(self, library_item_id, episode_id=None):
 		"""Start a playback session on the server"""
 		endpoint = f"/api/session/local"
@@ -232,9 +413,10 @@ class AudioBookShelfLibraryService:
 			data["episodeId"] = episode_id
 		
 		try:
-			response = requests.post(self.base_url + endpoint, headers=self.headers, json=data)
+			response = self._request("POST", self.base_url + endpoint, json=data)
 			response.raise_for_status()
 			session = response.json()
+			self._session_items[session.get('id')] = (library_item_id, episode_id)
 			xbmc.log(f"Started playback session: {session.get('id')}", xbmc.LOGINFO)
 			return session
 		except Exception as e:
@@ -242,7 +424,10 @@ class AudioBookShelfLibraryService:
 			return None
 	
 	def sync_playback_session(self, session_id, current_time, duration, time_listened=0):
-		"""Sync playback session with server"""
+		"""Sync playback session with server; returns None if it failed
+
+		The server also updates the media progress from a session sync.
+		"""
 		endpoint = f"/api/session/local/{session_id}/sync"
 		
 		data = {
@@ -252,9 +437,13 @@ class AudioBookShelfLibraryService:
 		}
 		
 		try:
-			response = requests.post(self.base_url + endpoint, headers=self.headers, json=data)
+			response = self._request("POST", self.base_url + endpoint, json=data)
+			self._invalidate_session_progress(session_id)
 			response.raise_for_status()
 			return response.json()
+		except json.JSONDecodeError:
+			# Synced, but no JSON body
+			return {}
 		except Exception as e:
 			xbmc.log(f"Error syncing playback session: {str(e)}", xbmc.LOGDEBUG)
 			return None
@@ -264,7 +453,9 @@ class AudioBookShelfLibraryService:
 		endpoint = f"/api/session/local/{session_id}/close"
 		
 		try:
-			response = requests.post(self.base_url + endpoint, headers=self.headers)
+			response = self._request("POST", self.base_url + endpoint)
+			self._invalidate_session_progress(session_id)
+			self._session_items.pop(session_id, None)
 			response.raise_for_status()
 			xbmc.log(f"Closed playback session: {session_id}", xbmc.LOGINFO)
 			return True
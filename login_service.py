@@ -1,8 +1,9 @@
-import requests
+from http_session import get_session
 
 class AudioBookShelfService:
-	def __init__(self, base_url):
+	def __init__(self, base_url, session=None):
 		self.base_url = base_url
+		self.session = session or get_session()
 
 	def login(self, username, password):
 		url = f"{self.base_url}/login"
@@ -43,11 +44,11 @@ class AudioBookShelfService:
 
 	def _post(self, url, payload=None):
 		headers = {"Content-Type": "application/json"}
-		response = requests.post(url, headers=headers, json=payload)
+		response = self.session.post(url, headers=headers, json=payload)
 		response.raise_for_status()
 		return response.json()
 
 	def _get(self, url):
-		response = requests.get(url)
+		response = self.session.get(url)
 		response.raise_for_status()
 		return response.json()
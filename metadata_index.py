@@ -0,0 +1,447 @@
+import os
+import re
+import time
+import sqlite3
+import xbmc
+from library_service import make_listing_record
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS libraries (
+	id TEXT PRIMARY KEY,
+	name TEXT NOT NULL,
+	media_type TEXT,
+	display_order INTEGER
+);
+CREATE TABLE IF NOT EXISTS items (
+	id TEXT PRIMARY KEY,
+	library_id TEXT NOT NULL,
+	media_type TEXT,
+	title TEXT,
+	sort_title TEXT,
+	author TEXT,
+	narrator TEXT,
+	series TEXT,
+	duration REAL,
+	num_episodes INTEGER,
+	num_files INTEGER,
+	added_at INTEGER,
+	updated_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS items_by_title ON items (library_id, sort_title COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS episodes (
+	id TEXT PRIMARY KEY,
+	item_id TEXT NOT NULL,
+	title TEXT,
+	duration REAL,
+	published_at INTEGER,
+	sort_rank INTEGER
+);
+CREATE INDEX IF NOT EXISTS episodes_by_rank ON episodes (item_id, sort_rank);
+CREATE TABLE IF NOT EXISTS sync_state (
+	key TEXT PRIMARY KEY,
+	synced_at REAL,
+	watermark INTEGER
+);
+"""
+
+# Full-text indexes for search; prefix indexes keep search-as-you-type lookups fast
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+	id UNINDEXED, title, author, narrator, series,
+	tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS episodes_fts USING fts5(
+	id UNINDEXED, item_id UNINDEXED, title,
+	tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+"""
+
+SEARCH_COLUMNS = ('title', 'author', 'narrator', 'series')
+
+EPISODE_COLUMNS = ('id', 'item_id', 'title', 'duration', 'published_at', 'sort_rank')
+
+ITEM_COLUMNS = (
+	'id', 'library_id', 'media_type', 'title', 'sort_title', 'author', 'narrator', 'series',
+	'duration', 'num_episodes', 'num_files', 'added_at', 'updated_at'
+)
+
+LIBRARIES_KEY = 'libraries'
+
+# Seconds between full reconciles of a library, which catch removals that
+# an incremental sync can't see when the item count happens to match
+FULL_SYNC_INTERVAL = 24 * 3600
+# A sync marked as running for longer than this is assumed to have died
+SYNC_CLAIM_TIMEOUT = 30 * 60
+
+
+def _search_words(query):
+	"""Split search input into words, dropping FTS syntax characters"""
+	return re.findall(r'\w+', query or '')
+
+
+class MetadataIndex:
+	"""Local SQLite copy of libraries and listing records
+
+	Titles, authors, narrators, series and known episode titles are kept in
+	FTS5 tables for search; SQLite builds without FTS5 fall back to LIKE.
+	"""
+
+	def __init__(self, db_path):
+		directory = os.path.dirname(db_path)
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+
+		self.conn = sqlite3.connect(db_path, timeout=10)
+		self.conn.row_factory = sqlite3.Row
+		# WAL lets listings read while a background sync writes
+		self.conn.execute('PRAGMA journal_mode=WAL')
+		self.conn.executescript(SCHEMA)
+		self.has_fts = self._create_search_tables()
+
+	def _create_search_tables(self):
+		"""Create the full-text tables; returns False if FTS5 is unavailable"""
+		exists = self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'items_fts'").fetchone()
+		try:
+			self.conn.executescript(FTS_SCHEMA)
+		except sqlite3.OperationalError as e:
+			xbmc.log(f"Full-text search unavailable, using LIKE: {str(e)}", xbmc.LOGINFO)
+			return False
+
+		if not exists:
+			# Index what an older version of the addon already stored
+			with self.conn:
+				self.conn.execute(
+					f'INSERT INTO items_fts (id, {",".join(SEARCH_COLUMNS)}) '
+					f'SELECT id, {",".join(SEARCH_COLUMNS)} FROM items'
+				)
+				self.conn.execute('INSERT INTO episodes_fts (id, item_id, title) SELECT id, item_id, title FROM episodes')
+		return True
+
+	def close(self):
+		self.conn.close()
+
+	def get_libraries(self):
+		"""Get indexed libraries in server order"""
+		rows = self.conn.execute('SELECT * FROM libraries ORDER BY display_order')
+		return [dict(row) for row in rows]
+
+	def replace_libraries(self, libraries):
+		"""Replace the library list with the server's"""
+		with self.conn:
+			self.conn.execute('DELETE FROM libraries')
+			self.conn.executemany(
+				'INSERT INTO libraries (id, name, media_type, display_order) VALUES (?, ?, ?, ?)',
+				[(lib['id'], lib['name'], lib.get('mediaType'), lib.get('displayOrder', i))
+				 for i, lib in enumerate(libraries)]
+			)
+			# Items of libraries that disappeared are no longer reachable
+			self.conn.execute('DELETE FROM items WHERE library_id NOT IN (SELECT id FROM libraries)')
+			if self.has_fts:
+				self.conn.execute('DELETE FROM items_fts WHERE id NOT IN (SELECT id FROM items)')
+
+	def get_items(self, library_id, limit=0, offset=0):
+		"""Get listing records of a library sorted by title"""
+		query = 'SELECT * FROM items WHERE library_id = ? ORDER BY sort_title COLLATE NOCASE'
+		params = [library_id]
+		if limit > 0:
+			query += ' LIMIT ? OFFSET ?'
+			params += [limit, offset]
+
+		return [dict(row) for row in self.conn.execute(query, params)]
+
+	def count_items(self, library_id):
+		row = self.conn.execute('SELECT COUNT(*) FROM items WHERE library_id = ?', (library_id,)).fetchone()
+		return row[0]
+
+	def upsert_items(self, library_id, records):
+		"""Insert or update listing records; returns how many were new or changed"""
+		if not records:
+			return 0
+
+		known = {}
+		ids = [record['id'] for record in records]
+		# Stay below SQLite's limit on bound parameters
+		for start in range(0, len(ids), 500):
+			chunk = ids[start:start + 500]
+			known.update(self.conn.execute(
+				f'SELECT id, updated_at FROM items WHERE id IN ({",".join("?" * len(chunk))})', chunk
+			).fetchall())
+
+		changed = [record for record in records
+				   if record['id'] not in known or known[record['id']] != record['updated_at']]
+
+		with self.conn:
+			self.conn.executemany(
+				f'INSERT OR REPLACE INTO items ({",".join(ITEM_COLUMNS)}) '
+				f'VALUES ({",".join("?" * len(ITEM_COLUMNS))})',
+				[tuple(dict(record, library_id=library_id)[col] for col in ITEM_COLUMNS) for record in changed]
+			)
+			if self.has_fts:
+				self.conn.executemany('DELETE FROM items_fts WHERE id = ?', [(record['id'],) for record in changed])
+				self.conn.executemany(
+					f'INSERT INTO items_fts (id, {",".join(SEARCH_COLUMNS)}) VALUES (?, ?, ?, ?, ?)',
+					[(record['id'],) + tuple(record[col] for col in SEARCH_COLUMNS) for record in changed]
+				)
+
+		return len(changed)
+
+	def delete_items_except(self, library_id, keep_ids):
+		"""Remove items of a library that the server no longer lists"""
+		keep_ids = set(keep_ids)
+		rows = self.conn.execute('SELECT id FROM items WHERE library_id = ?', (library_id,)).fetchall()
+		stale = [(row[0],) for row in rows if row[0] not in keep_ids]
+
+		with self.conn:
+			self.conn.executemany('DELETE FROM items WHERE id = ?', stale)
+			self.conn.executemany('DELETE FROM episodes WHERE item_id = ?', stale)
+			if self.has_fts:
+				self.conn.executemany('DELETE FROM items_fts WHERE id = ?', stale)
+				self.conn.executemany('DELETE FROM episodes_fts WHERE item_id = ?', stale)
+
+		return len(stale)
+
+	def replace_episodes(self, item_id, episodes):
+		"""Store a podcast's episodes; sort_rank 0 is listed first"""
+		with self.conn:
+			self.conn.execute('DELETE FROM episodes WHERE item_id = ?', (item_id,))
+			self.conn.executemany(
+				f'INSERT OR REPLACE INTO episodes ({",".join(EPISODE_COLUMNS)}) '
+				f'VALUES ({",".join("?" * len(EPISODE_COLUMNS))})',
+				[tuple(dict(episode, item_id=item_id)[col] for col in EPISODE_COLUMNS) for episode in episodes]
+			)
+			if self.has_fts:
+				self.conn.execute('DELETE FROM episodes_fts WHERE item_id = ?', (item_id,))
+				self.conn.executemany(
+					'INSERT INTO episodes_fts (id, item_id, title) VALUES (?, ?, ?)',
+					[(episode['id'], item_id, episode['title']) for episode in episodes]
+				)
+
+	def get_episodes(self, item_id, limit=0, offset=0):
+		"""Get stored episodes of a podcast in listing order"""
+		query = 'SELECT * FROM episodes WHERE item_id = ? ORDER BY sort_rank'
+		params = [item_id]
+		if limit > 0:
+			query += ' LIMIT ? OFFSET ?'
+			params += [limit, offset]
+
+		return [dict(row) for row in self.conn.execute(query, params)]
+
+	def count_episodes(self, item_id):
+		row = self.conn.execute('SELECT COUNT(*) FROM episodes WHERE item_id = ?', (item_id,)).fetchone()
+		return row[0]
+
+	def episodes_fresh(self, item_id, interval):
+		"""Whether a podcast's stored episodes can be listed without re-fetching
+
+		Podcasts in an indexed library are compared by updated_at and episode
+		count; others are re-fetched once interval seconds have passed.
+		"""
+		synced_at, watermark = self.get_sync_state(episodes_key(item_id))
+		if synced_at is None:
+			return False
+
+		row = self.conn.execute('SELECT updated_at, num_episodes FROM items WHERE id = ?', (item_id,)).fetchone()
+		if row is None:
+			return time.time() - synced_at < interval
+		return row['updated_at'] == watermark and row['num_episodes'] == self.count_episodes(item_id)
+
+	def search(self, query, limit=50):
+		"""Find items and episodes whose text contains every word of query
+
+		Returns (item records, episode records); episode records carry the
+		podcast title as item_title. Words match as prefixes.
+		"""
+		words = _search_words(query)
+		if not words:
+			return [], []
+
+		if self.has_fts:
+			match = ' '.join(f'"{word}"*' for word in words)
+			items = self.conn.execute(
+				'SELECT items.* FROM items_fts JOIN items ON items.id = items_fts.id '
+				'WHERE items_fts MATCH ? ORDER BY items_fts.rank LIMIT ?',
+				(match, limit)
+			).fetchall()
+			episodes = self.conn.execute(
+				'SELECT episodes.*, items.title AS item_title FROM episodes_fts '
+				'JOIN episodes ON episodes.id = episodes_fts.id '
+				'LEFT JOIN items ON items.id = episodes.item_id '
+				'WHERE episodes_fts MATCH ? ORDER BY episodes_fts.rank LIMIT ?',
+				(match, limit)
+			).fetchall()
+		else:
+			any_column = '(' + ' OR '.join(f'{col} LIKE ?' for col in SEARCH_COLUMNS) + ')'
+			items = self.conn.execute(
+				f'SELECT * FROM items WHERE {" AND ".join([any_column] * len(words))} '
+				'ORDER BY sort_title COLLATE NOCASE LIMIT ?',
+				[f'%{word}%' for word in words for col in SEARCH_COLUMNS] + [limit]
+			).fetchall()
+			episodes = self.conn.execute(
+				'SELECT episodes.*, items.title AS item_title FROM episodes '
+				'LEFT JOIN items ON items.id = episodes.item_id '
+				f'WHERE {" AND ".join(["episodes.title LIKE ?"] * len(words))} '
+				'ORDER BY episodes.published_at DESC LIMIT ?',
+				[f'%{word}%' for word in words] + [limit]
+			).fetchall()
+
+		return [dict(row) for row in items], [dict(row) for row in episodes]
+
+	def get_sync_state(self, key):
+		"""Return (synced_at, watermark) for a sync key, or (None, 0)"""
+		row = self.conn.execute('SELECT synced_at, watermark FROM sync_state WHERE key = ?', (key,)).fetchone()
+		if not row:
+			return None, 0
+		return row['synced_at'], row['watermark'] or 0
+
+	def set_sync_state(self, key, watermark=0):
+		with self.conn:
+			self.conn.execute(
+				'INSERT OR REPLACE INTO sync_state (key, synced_at, watermark) VALUES (?, ?, ?)',
+				(key, time.time(), watermark)
+			)
+
+	def claim_sync(self, key):
+		"""Mark a sync of key as running; returns False if another one already is
+
+		Overlapping plugin invocations and the service share the index, so
+		only the first of them syncs a library while the others move on.
+		"""
+		now = time.time()
+		marker = f'{key}:running'
+		with self.conn:
+			self.conn.execute(
+				'DELETE FROM sync_state WHERE key = ? AND synced_at < ?', (marker, now - SYNC_CLAIM_TIMEOUT)
+			)
+			cursor = self.conn.execute(
+				'INSERT OR IGNORE INTO sync_state (key, synced_at, watermark) VALUES (?, ?, 0)', (marker, now)
+			)
+		return cursor.rowcount == 1
+
+	def release_sync(self, key):
+		with self.conn:
+			self.conn.execute('DELETE FROM sync_state WHERE key = ?', (f'{key}:running',))
+
+	def is_synced(self, key):
+		return self.get_sync_state(key)[0] is not None
+
+	def sync_due(self, key, interval):
+		"""Whether the last sync of key is older than interval seconds"""
+		synced_at = self.get_sync_state(key)[0]
+		return synced_at is None or time.time() - synced_at >= interval
+
+
+def episodes_key(item_id):
+	"""Sync state key of a podcast's episode list"""
+	return f'episodes:{item_id}'
+
+
+def _episode_sort_key(episode):
+	if episode.get('index') is not None:
+		return (0, episode.get('index'))
+	elif episode.get('episode') is not None:
+		return (1, episode.get('episode'))
+	elif episode.get('publishedAt'):
+		return (2, episode.get('publishedAt'))
+	else:
+		return (3, episode.get('title', ''))
+
+
+def sync_episodes(index, library_service, item_id):
+	"""Fetch a podcast's episodes, sort them once and store them; returns the count"""
+	item = library_service.get_library_item_by_id(item_id)
+	episodes = sorted(item.get('media', {}).get('episodes', []), key=_episode_sort_key, reverse=True)
+
+	index.replace_episodes(item_id, [
+		{
+			'id': episode.get('id'),
+			'title': episode.get('title', 'Unknown Episode'),
+			# The plain item response only has the duration on the audio file
+			'duration': episode.get('duration') or (episode.get('audioFile') or {}).get('duration', 0),
+			'published_at': episode.get('publishedAt') or 0,
+			'sort_rank': rank
+		}
+		for rank, episode in enumerate(episodes)
+	])
+	index.set_sync_state(episodes_key(item_id), item.get('updatedAt') or 0)
+	return len(episodes)
+
+
+def sync_libraries(index, library_service):
+	"""Refresh the library list from the server"""
+	libraries = library_service.get_all_libraries().get('libraries', [])
+	index.replace_libraries(libraries)
+	index.set_sync_state(LIBRARIES_KEY)
+	return libraries
+
+
+def sync_library(index, library_service, library_id, page_size=100):
+	"""Bring a library's items up to date; returns the number of changed rows
+
+	Items are requested newest-updated first, so an incremental sync can stop at
+	the first page that reaches the previous watermark. If the item count still
+	differs from the server afterwards (e.g. items were removed), or the last
+	full sync is older than FULL_SYNC_INTERVAL, a full sync reconciles the index.
+	Nothing is done while another process is syncing the same library.
+	"""
+	if not index.claim_sync(library_id):
+		xbmc.log(f"Library {library_id} is already being synced", xbmc.LOGDEBUG)
+		return 0
+
+	try:
+		return _sync_library(index, library_service, library_id, page_size)
+	finally:
+		index.release_sync(library_id)
+
+
+def _sync_library(index, library_service, library_id, page_size):
+	_, watermark = index.get_sync_state(library_id)
+	page_size = page_size or 100
+	changed = 0
+	new_watermark = watermark
+	total = None
+
+	pages = library_service.iter_library_item_pages(
+		library_id, page_size=page_size, sort='updatedAt', desc=1, minified=1
+	)
+	for data in pages:
+		total = data.get('total', 0)
+		records = [make_listing_record(item) for item in data.get('results', [])]
+		changed += index.upsert_items(library_id, records)
+		new_watermark = max([new_watermark] + [record['updated_at'] for record in records])
+
+		if watermark and any(record['updated_at'] <= watermark for record in records):
+			break
+
+	full_key = f'{library_id}:full'
+	if not watermark:
+		# A first sync reads every page anyway
+		index.set_sync_state(full_key)
+
+	if total is not None and index.count_items(library_id) != total:
+		xbmc.log(f"Index of library {library_id} out of step, running full sync", xbmc.LOGINFO)
+		changed += _full_sync(index, library_service, library_id, page_size)
+		index.set_sync_state(full_key)
+	elif total is not None and index.sync_due(full_key, FULL_SYNC_INTERVAL):
+		xbmc.log(f"Periodic full sync of library {library_id}", xbmc.LOGINFO)
+		changed += _full_sync(index, library_service, library_id, page_size)
+		index.set_sync_state(full_key)
+	elif total is None:
+		# Empty library
+		changed += index.delete_items_except(library_id, [])
+
+	index.set_sync_state(library_id, new_watermark)
+	return changed
+
+
+def _full_sync(index, library_service, library_id, page_size):
+	"""Re-read every item of a library and drop the ones that are gone"""
+	seen = []
+	changed = 0
+
+	for data in library_service.iter_library_item_pages(library_id, page_size=page_size, minified=1):
+		records = [make_listing_record(item) for item in data.get('results', [])]
+		seen += [record['id'] for record in records]
+		changed += index.upsert_items(library_id, records)
+
+	changed += index.delete_items_except(library_id, seen)
+	return changed
@@ -8,117 +8,398 @@ except ImportError:
 	import simplejson as json
 
 
-class PlaybackMonitor:
-	"""Monitor playback and sync progress with Audiobookshelf server"""
+class SyncScheduler:
+	"""Decide when the next periodic progress sync is due
+
+	The interval starts at min_interval and grows towards max_interval during
+	steady playback. It is reset by user interaction (resume, seek) and
+	stretched further while requests are slow or failing.
+	"""
+	
+	GROWTH = 1.5
+	# Requests slower than this many seconds count as a sign of a poor network
+	SLOW_REQUEST = 2.0
+	
+	def __init__(self, min_interval=10, max_interval=60):
+		self.min_interval = max(1, min_interval)
+		self.max_interval = max(self.min_interval, max_interval)
+		self.interval = self.min_interval
+		self.failures = 0
+		self.slow = False
+		self.last_sync_time = 0
+		self.last_position = None
+	
+	def current_interval(self):
+		"""Interval to wait now, including the network health penalty"""
+		interval = self.interval
+		if self.failures:
+			interval *= 2 ** min(self.failures, 4)
+		elif self.slow:
+			interval *= 2
+		return interval
+	
+	def reset(self, now):
+		"""Return to the shortest interval, counting from now"""
+		self.interval = self.min_interval
+		self.last_sync_time = now
+	
+	def is_due(self, now, position):
+		"""Whether a periodic sync should happen now"""
+		if now - self.last_sync_time < self.current_interval():
+			return False
+		
+		# Nothing new to report (e.g. buffering); check again next interval
+		if position == self.last_position:
+			self.last_sync_time = now
+			return False
+		
+		return True
+	
+	def record(self, now, position, succeeded, elapsed):
+		"""Account for a finished sync and pick the next interval"""
+		self.last_sync_time = now
+		self.last_position = position
+		self.slow = elapsed > self.SLOW_REQUEST
+		
+		if succeeded:
+			self.failures = 0
+			self.interval = min(self.max_interval, self.interval * self.GROWTH)
+		else:
+			self.failures += 1
+
+
+class ListeningClock:
+	"""Accumulate time actually spent playing, on a monotonic clock
+
+	Pauses are not counted. The server expects the time listened since the
+	previous sync, so time is handed out with pending() and only removed
+	with commit() once the server has accepted it.
+	"""
+	
+	def __init__(self):
+		self.running_since = None
+		self.unreported = 0.0
+		self.total = 0.0
+	
+	def _collect(self):
+		if self.running_since is not None:
+			now = time.monotonic()
+			elapsed = now - self.running_since
+			self.running_since = now
+			self.unreported += elapsed
+			self.total += elapsed
+	
+	def start(self):
+		"""Playback is running"""
+		if self.running_since is None:
+			self.running_since = time.monotonic()
+	
+	def stop(self):
+		"""Playback paused or stopped"""
+		self._collect()
+		self.running_since = None
+	
+	def pending(self):
+		"""Whole seconds listened that the server hasn't been told about"""
+		self._collect()
+		return int(self.unreported)
+	
+	def commit(self, seconds):
+		"""The server accepted this much listening time"""
+		self.unreported -= seconds
+
+
+class PlaybackMonitor(xbmc.Player):
+	"""Monitor playback and sync progress with Audiobookshelf server
+
+	Reacts to Kodi player callbacks: progress is synced right away on pause,
+	seek and stop, and otherwise on the SyncScheduler's schedule while playing.
+	"""
+	
+	# Seconds between position samples; sampling is local and cheap
+	POLL_INTERVAL = 1
+	# Give up if playback hasn't started after this many seconds
+	START_TIMEOUT = 30
+	# Seconds between local journal writes of the position
+	JOURNAL_INTERVAL = 5
 	
-	def __init__(self, library_service, item_id, duration, episode_id=None, sync_kodi_watched=False, episode_title=None):
+	def __init__(self, library_service, item_id, duration, episode_id=None, sync_kodi_watched=False, episode_title=None, session_id=None, url=None, file_offset=0, tracks=None, timeline=None, title=None, progress_queue=None, min_sync_interval=10, max_sync_interval=60):
+		super().__init__()
 		self.library_service = library_service
 		self.item_id = item_id
 		self.episode_id = episode_id
 		self.duration = duration
-		self.player = xbmc.Player()
-		self.session_id = None
+		self.kodi_monitor = xbmc.Monitor()
+		self.session_id = session_id
+		# Optional ProgressQueue that progress is journaled to before it is sent
+		self.progress_queue = progress_queue
+		self.last_journal_time = 0
+		self.last_journal_position = None
 		self.is_monitoring = False
-		self.monitor_thread = None
-		self.last_sync_time = 0
-		self.sync_interval = 10  # Sync every 10 seconds
+		self.has_started = False
+		self.is_paused = False
+		# URL handed to Kodi, used to recognise playback that is already running
+		self.url = url
+		# Absolute book position at which the file at url starts
+		self.file_offset = file_offset
+		# (url, absolute offset) of every file when a whole book is queued as a playlist
+		self.tracks = tracks or []
+		# Timeline of the book's chapters, used to show the chapter being played
+		self.timeline = timeline
+		self.title = title
+		self.current_chapter = None
+		self.playing_file = None
+		self.last_position = 0
+		self.scheduler = SyncScheduler(min_sync_interval, max_sync_interval)
 		self.start_time = None
-		self.total_time_listened = 0
+		self.listening_clock = ListeningClock()
 		self.sync_kodi_watched = sync_kodi_watched
 		self.episode_title = episode_title
 		self.marked_as_watched = False
+		self.sync_lock = threading.Lock()
+		self.finished = threading.Event()
 		
 	def start_monitoring(self, start_position=0):
-		"""Start monitoring playback"""
+		"""Prepare monitoring; call before handing the item to Kodi
+
+		start_position is the absolute position playback starts from. Kodi
+		opens the stream there itself via the item's StartOffset property.
+		"""
 		xbmc.log(f"Starting playback monitor for item {self.item_id}", xbmc.LOGINFO)
 		
-		# Start playback session on server
-		session = self.library_service.start_playback_session(self.item_id, self.episode_id)
-		if session:
-			self.session_id = session.get('id')
-			xbmc.log(f"Playback session started: {self.session_id}", xbmc.LOGINFO)
-		
-		# Seek to start position if resuming
-		if start_position > 0 and self.player.isPlaying():
-			try:
-				xbmc.log(f"Seeking to resume position: {start_position}s", xbmc.LOGINFO)
-				xbmc.sleep(1000)  # Wait a bit for player to be ready
-				self.player.seekTime(start_position)
-			except Exception as e:
-				xbmc.log(f"Error seeking to start position: {str(e)}", xbmc.LOGERROR)
+		# Start playback session on server unless one was started before playback
+		if not self.session_id:
+			session = self.library_service.start_playback_session(self.item_id, self.episode_id)
+			if session:
+				self.session_id = session.get('id')
+				xbmc.log(f"Playback session started: {self.session_id}", xbmc.LOGINFO)
 		
+		self.last_position = start_position
 		self.start_time = time.time()
 		self.is_monitoring = True
+	
+	def run(self):
+		"""Block until playback ends, syncing on schedule in between"""
+		while self.tick() and not self.kodi_monitor.waitForAbort(self.POLL_INTERVAL):
+			pass
+		
+		self.stop_monitoring()
+	
+	def tick(self):
+		"""Do one round of monitoring; returns False once monitoring is over
+
+		Called every POLL_INTERVAL seconds, either by run() or by the service.
+		"""
+		if not self.is_monitoring:
+			return False
+		
+		if not self.has_started:
+			# The start callback may have fired before this monitor existed
+			if self.isPlayingAudio() and self._is_own_file(self.getPlayingFile()):
+				self.onAVStarted()
+			elif time.time() - self.start_time > self.START_TIMEOUT:
+				xbmc.log("Playback did not start, stopping monitor", xbmc.LOGINFO)
+				return False
+			return True
 		
-		# Start monitoring thread
-		self.monitor_thread = threading.Thread(target=self._monitor_loop)
-		self.monitor_thread.daemon = True
-		self.monitor_thread.start()
-	
-	def _monitor_loop(self):
-		"""Main monitoring loop"""
-		last_position = 0
-		
-		while self.is_monitoring and self.player.isPlayingAudio():
-			try:
-				current_time = self.player.getTime()
-				
-				# Calculate time listened since last update
-				if self.player.isPlaying():
-					time_since_last_sync = time.time() - self.last_sync_time
-					if time_since_last_sync >= self.sync_interval:
-						# Update progress on server
-						self._sync_progress(current_time)
-						self.last_sync_time = time.time()
-						last_position = current_time
-				
-			except Exception as e:
-				xbmc.log(f"Error in monitor loop: {str(e)}", xbmc.LOGDEBUG)
+		try:
+			self._sample_position()
+			self._show_chapter()
 			
-			xbmc.sleep(2000)  # Check every 2 seconds
+			if not self.is_paused and self.scheduler.is_due(time.time(), self.last_position):
+				self._sync_now()
+			elif (self.progress_queue and not self.is_paused
+				  and self.last_position != self.last_journal_position
+				  and time.time() - self.last_journal_time >= self.JOURNAL_INTERVAL):
+				self._journal(self.last_position)
+		except Exception as e:
+			xbmc.log(f"Error in monitor loop: {str(e)}", xbmc.LOGDEBUG)
 		
-		# Final sync when playback ends
-		if last_position > 0:
-			try:
-				final_time = self.player.getTime() if self.player.isPlayingAudio() else last_position
-				self._sync_progress(final_time, is_final=True)
-			except:
-				pass
+		return True
+	
+	def _sample_position(self):
+		"""Remember the current absolute position so it is known after playback stops"""
+		if self.isPlayingAudio():
+			self.last_position = self.file_offset + self.getTime()
+	
+	def _show_chapter(self):
+		"""Show the chapter containing the current position as the playing title"""
+		if not self.timeline or not self.timeline.chapters:
+			return
+		
+		index = self.timeline.chapter_at(self.last_position)
+		if index is None or index == self.current_chapter:
+			return
+		
+		self.current_chapter = index
+		chapter_title = self.timeline.chapters[index].get('title') or f'Chapter {index + 1}'
+		
+		list_item = xbmcgui.ListItem(label=chapter_title, path=self.playing_file)
+		list_item.setInfo('music', {'title': chapter_title, 'album': self.title or ''})
+		try:
+			self.updateInfoTag(list_item)
+		except Exception as e:
+			xbmc.log(f"Error showing current chapter: {str(e)}", xbmc.LOGDEBUG)
+	
+	def _sync_now(self, is_final=False):
+		"""Sync the last known position, serialized between callback and loop threads"""
+		with self.sync_lock:
+			started = time.time()
+			position = self.last_position
+			succeeded = True
+			if position > 0:
+				succeeded = self._sync_progress(position, is_final=is_final)
+			self.scheduler.record(time.time(), position, succeeded, time.time() - started)
+	
+	def onAVStarted(self):
+		if not self.is_monitoring:
+			return
+		
+		playing_file = self.getPlayingFile()
+		if self.has_started:
+			if playing_file == self.playing_file:
+				return
+			track = self._track_index(playing_file)
+			if track is None:
+				# Something else is playing now; this item's playback is over
+				self.stop_monitoring()
+				return
+			# Kodi moved on to the next file of the book's playlist
+			self.playing_file = playing_file
+			self.file_offset = self.tracks[track][1]
+			self.scheduler.reset(time.time())
+			return
+		
+		if not self._is_own_file(playing_file):
+			# Kodi is still playing what was on before this item
+			return
 		
-		xbmc.log("Playback monitor stopped", xbmc.LOGINFO)
+		self.has_started = True
+		self.playing_file = playing_file
+		track = self._track_index(playing_file)
+		if track is not None:
+			self.file_offset = self.tracks[track][1]
+		self.listening_clock.start()
+		
+		self.scheduler.reset(time.time())
+	
+	def onPlayBackPaused(self):
+		if self.is_monitoring and self.has_started:
+			self.is_paused = True
+			self.listening_clock.stop()
+			self._sample_position()
+			self._sync_now()
+	
+	def onPlayBackResumed(self):
+		if self.is_monitoring and self.has_started:
+			self.is_paused = False
+			self.listening_clock.start()
+			self.scheduler.reset(time.time())
+	
+	def onPlayBackSeek(self, time_ms, seek_offset):
+		if self.is_monitoring and self.has_started:
+			self.last_position = self.file_offset + time_ms / 1000.0
+			self._sync_now()
+			self.scheduler.reset(time.time())
+	
+	# The monitor is created before Kodi switches to its item, so stop, end and
+	# error callbacks before the start belong to whatever played previously
+	def onPlayBackStopped(self):
+		if self.has_started:
+			self.stop_monitoring()
+	
+	def onPlayBackEnded(self):
+		if not self.has_started:
+			return
+		track = self._track_index(self.playing_file)
+		if track is not None and track + 1 < len(self.tracks):
+			# The playlist continues with the next file; keep the session open
+			if self.is_monitoring and self.has_started:
+				self.last_position = self.tracks[track + 1][1]
+				self._sync_now()
+			return
+		self.stop_monitoring()
+	
+	def onPlayBackError(self):
+		if self.has_started:
+			self.stop_monitoring()
+	
+	def _is_own_file(self, playing_file):
+		"""Whether Kodi is playing this monitor's item"""
+		return not self.url or playing_file == self.url or self._track_index(playing_file) is not None
+	
+	def _track_index(self, url):
+		"""Index of a queued book file by URL, or None"""
+		for i, (track_url, offset) in enumerate(self.tracks):
+			if track_url == url:
+				return i
+		return None
+	
+	def _is_finished(self, current_time, is_final=False):
+		"""Finished within the last 30 seconds, or the last minute when stopping"""
+		return (self.duration - current_time) < 30 or is_final and (self.duration - current_time) < 60
+	
+	def _journal(self, current_time, is_final=False):
+		"""Record the position locally so it survives failed or skipped syncs"""
+		if current_time <= 0:
+			return None
+		
+		self.last_journal_time = time.time()
+		self.last_journal_position = current_time
+		return self.progress_queue.record(
+			self.item_id, self.episode_id, current_time, self.duration,
+			is_finished=self._is_finished(current_time, is_final)
+		)
 	
 	def _sync_progress(self, current_time, is_final=False):
-		"""Sync current progress to server"""
+		"""Sync current progress to server; returns whether the server got it"""
 		try:
-			# Calculate if finished (within last 30 seconds)
-			is_finished = (self.duration - current_time) < 30 or is_final and (self.duration - current_time) < 60
+			is_finished = self._is_finished(current_time, is_final)
 			
-			# Update progress
-			self.library_service.update_media_progress(
-				self.item_id,
-				current_time,
-				self.duration,
-				is_finished=is_finished,
-				episode_id=self.episode_id
-			)
+			# Sync session if we have one; the server updates progress from it too
+			session_synced = False
+			if self.session_id:
+				# Only the time listened since the last successful sync
+				time_listened = self.listening_clock.pending()
+				session_synced = self.library_service.sync_playback_session(
+					self.session_id,
+					current_time,
+					self.duration,
+					time_listened=time_listened
+				) is not None
+				if session_synced:
+					self.listening_clock.commit(time_listened)
+			
+			# A session sync doesn't carry the finished flag, so that still
+			# needs an explicit progress update
+			progress_synced = session_synced and not is_finished
+			
+			# Update progress, through the journal if there is one
+			if self.progress_queue:
+				entry = self._journal(current_time, is_final)
+				if entry and progress_synced:
+					self.progress_queue.remove([entry])
+				succeeded = self.progress_queue.flush(self.library_service, force=is_final)
+			elif not progress_synced:
+				succeeded = self.library_service.update_media_progress(
+					self.item_id,
+					current_time,
+					self.duration,
+					is_finished=is_finished,
+					episode_id=self.episode_id
+				) is not None
+			else:
+				succeeded = True
 			
 			# Mark as watched in Kodi if finished and sync enabled
 			if is_finished and self.sync_kodi_watched and not self.marked_as_watched:
 				self._mark_as_watched_in_kodi()
 				self.marked_as_watched = True
 			
-			# Sync session if we have one
-			if self.session_id:
-				time_listened = time.time() - self.start_time
-				self.library_service.sync_playback_session(
-					self.session_id,
-					current_time,
-					self.duration,
-					time_listened=int(time_listened)
-				)
-			
+			return succeeded
 		except Exception as e:
 			xbmc.log(f"Error syncing progress: {str(e)}", xbmc.LOGERROR)
+			return False
 	
 	def _mark_as_watched_in_kodi(self):
 		"""Mark episode as watched in Kodi's database"""
@@ -154,49 +435,60 @@ class PlaybackMonitor:
 			xbmc.log(f"Error marking as watched in Kodi: {str(e)}", xbmc.LOGDEBUG)
 	
 	def stop_monitoring(self):
-		"""Stop monitoring and close session"""
+		"""Do the final sync and close the session; safe to call more than once"""
+		with self.sync_lock:
+			if self.finished.is_set():
+				return
+			self.finished.set()
+			self.is_monitoring = False
+		
 		xbmc.log("Stopping playback monitor", xbmc.LOGINFO)
-		self.is_monitoring = False
+		self.listening_clock.stop()
 		
-		# Wait for thread to finish
-		if self.monitor_thread and self.monitor_thread.is_alive():
-			self.monitor_thread.join(timeout=5)
+		# Final sync when playback ends
+		if self.has_started:
+			self._sync_now(is_final=True)
 		
 		# Close session on server
 		if self.session_id:
 			self.library_service.close_playback_session(self.session_id)
 			self.session_id = None
+		
+		xbmc.log(f"Playback monitor stopped after {self.listening_clock.total:.0f}s of listening", xbmc.LOGINFO)
 
 
 def get_resume_position(library_service, item_id, episode_id=None):
 	"""Get resume position from server"""
 	try:
 		progress = library_service.get_media_progress(item_id, episode_id)
-		
-		if progress:
-			current_time = progress.get('currentTime', 0)
-			is_finished = progress.get('isFinished', False)
-			
-			# Don't resume if already finished
-			if is_finished:
-				xbmc.log("Item already finished, starting from beginning", xbmc.LOGINFO)
-				return 0
-			
-			# Don't resume if less than 10 seconds
-			if current_time < 10:
-				return 0
-			
-			xbmc.log(f"Found resume position: {current_time}s", xbmc.LOGINFO)
-			return current_time
-		else:
-			xbmc.log("No resume position found", xbmc.LOGINFO)
-			return 0
-			
+		return resume_position_from_progress(progress)
 	except Exception as e:
 		xbmc.log(f"Error getting resume position: {str(e)}", xbmc.LOGERROR)
 		return 0
 
 
+def resume_position_from_progress(progress):
+	"""Get the position to offer resuming from, given a media progress response"""
+	if progress:
+		current_time = progress.get('currentTime', 0)
+		is_finished = progress.get('isFinished', False)
+		
+		# Don't resume if already finished
+		if is_finished:
+			xbmc.log("Item already finished, starting from beginning", xbmc.LOGINFO)
+			return 0
+		
+		# Don't resume if less than 10 seconds
+		if current_time < 10:
+			return 0
+		
+		xbmc.log(f"Found resume position: {current_time}s", xbmc.LOGINFO)
+		return current_time
+	else:
+		xbmc.log("No resume position found", xbmc.LOGINFO)
+		return 0
+
+
 def ask_resume(current_time, duration):
 	"""Ask user if they want to resume"""
 	if current_time < 10:
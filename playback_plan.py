@@ -0,0 +1,142 @@
+import xbmc
+from concurrent.futures import ThreadPoolExecutor
+from playback_monitor import resume_position_from_progress
+from timeline import get_timeline
+
+
+class PlaybackPlan:
+	"""Everything a play route needs, resolved from a single item fetch"""
+
+	def __init__(self, item_id, url, title, duration, episode_id=None, resume_position=0,
+				 start_position=0, seek_position=0, file_offset=0, chapters=None, audio_files=None,
+				 timeline=None, tracks=None, session_id=None):
+		self.item_id = item_id
+		self.episode_id = episode_id
+		self.url = url
+		self.title = title
+		self.duration = duration
+		# Absolute position the server has saved for this item (0 if none)
+		self.resume_position = resume_position
+		# Absolute position playback was chosen to start from
+		self.start_position = start_position
+		# Position within the file at url that playback starts from
+		self.seek_position = seek_position
+		# Absolute position at which the file at url starts
+		self.file_offset = file_offset
+		self.chapters = chapters or []
+		self.audio_files = audio_files or []
+		self.timeline = timeline
+		# (url, absolute offset) of each audio file, for queueing the whole book
+		self.tracks = tracks or []
+		# Server playback session started alongside resolution
+		self.session_id = session_id
+
+
+def _find_episode(item, episode_id):
+	for episode in item.get('media', {}).get('episodes', []):
+		if episode.get('id') == episode_id:
+			return episode
+	raise ValueError("Episode not found")
+
+
+def resolve_playback_plan(library_service, item_id, episode_id=None, file_ino=None,
+						  chapter_start=None, with_resume=True, choose_start=None, downloads=None):
+	"""Fetch an item once and work out URL, metadata, resume position and session
+
+	Item detail, media progress and the playback session are requested
+	concurrently. choose_start(resume_position, duration) is called as soon as
+	progress arrives, while the item may still be loading, and returns the
+	position to start from. chapter_start, if given, is used instead.
+
+	Podcast episodes are looked up in the plain item response rather than
+	the expanded one, so their duration comes from the episode's audio file.
+	Files present in the optional DownloadManager are played from disk.
+	"""
+	with ThreadPoolExecutor(max_workers=3) as pool:
+		item_future = pool.submit(library_service.get_library_item_by_id, item_id)
+		session_future = pool.submit(library_service.start_playback_session, item_id, episode_id)
+		progress_future = pool.submit(library_service.get_media_progress, item_id, episode_id) if with_resume else None
+
+		try:
+			resume_position = 0
+			start_position = chapter_start or 0
+			if progress_future:
+				progress = progress_future.result()
+				resume_position = resume_position_from_progress(progress)
+				if resume_position > 0 and choose_start:
+					start_position = choose_start(resume_position, (progress or {}).get('duration', 0))
+
+			item = item_future.result()
+			plan = _build_plan(library_service, item_id, item, episode_id, file_ino, start_position, downloads)
+		except Exception:
+			# Don't leave an orphaned session behind on the server
+			session = session_future.result()
+			if session:
+				library_service.close_playback_session(session.get('id'))
+			raise
+
+		session = session_future.result()
+
+	plan.resume_position = resume_position
+	plan.session_id = session.get('id') if session else None
+	return plan
+
+
+def _build_plan(library_service, item_id, item, episode_id, file_ino, start_position, downloads=None):
+	"""Work out what to play from a fetched item
+
+	start_position is an absolute book position; for multi-file books it is
+	mapped to the file containing it and a position within that file.
+	"""
+	media = item.get('media', {})
+	timeline = get_timeline(item)
+	file_offset = 0
+	seek_position = start_position
+	tracks = []
+
+	def file_url(audio_file):
+		"""Local copy of a file if downloaded, else its stream URL"""
+		local = downloads.local_path(item_id, audio_file) if downloads else None
+		return local or library_service.get_direct_file_url(item_id, audio_file.get('ino'))
+
+	if episode_id:
+		episode = _find_episode(item, episode_id)
+		title = episode.get('title', 'Unknown')
+		duration = episode.get('duration') or (episode.get('audioFile') or {}).get('duration', 0)
+		local = downloads.local_path(item_id, episode.get('audioFile')) if downloads else None
+		url = local or library_service.get_file_url(item_id, episode_id=episode_id, item=item)
+	else:
+		title = media.get('metadata', {}).get('title', 'Unknown')
+		duration = media.get('duration', 0)
+
+		if file_ino:
+			file_index = timeline.index_of(file_ino)
+			if file_index is None:
+				raise ValueError("File not found")
+			file_offset = start_position = timeline.file_offset(file_index)
+			seek_position = 0
+			url = file_url(timeline.files[file_index])
+		elif len(timeline) and all(f.get('ino') for f in timeline.files):
+			tracks = [
+				(file_url(f), timeline.file_offset(i))
+				for i, f in enumerate(timeline.files)
+			]
+			file_index, seek_position = timeline.locate(start_position)
+			file_offset = timeline.file_offset(file_index)
+			url = tracks[file_index][0]
+		else:
+			url = library_service.get_file_url(item_id, item=item)
+
+	xbmc.log(f"Resolved playback of {item_id}: {title}", xbmc.LOGDEBUG)
+
+	return PlaybackPlan(
+		item_id, url, title, duration,
+		episode_id=episode_id,
+		start_position=start_position,
+		seek_position=seek_position,
+		file_offset=file_offset,
+		chapters=timeline.chapters,
+		audio_files=timeline.files,
+		timeline=timeline,
+		tracks=tracks
+	)
@@ -0,0 +1,127 @@
+import os
+import time
+import sqlite3
+import threading
+import xbmc
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending_progress (
+	item_id TEXT NOT NULL,
+	episode_id TEXT NOT NULL DEFAULT '',
+	position REAL NOT NULL,
+	duration REAL NOT NULL,
+	is_finished INTEGER NOT NULL,
+	recorded_at REAL NOT NULL,
+	PRIMARY KEY (item_id, episode_id)
+);
+"""
+
+MIN_BACKOFF = 5
+MAX_BACKOFF = 300
+
+
+class ProgressQueue:
+	"""Write-ahead journal of progress updates that still have to reach the server
+
+	Each item/episode has at most one pending row, so repeated updates while
+	offline coalesce into the latest position. flush() replays pending rows
+	and backs off exponentially while the server is unreachable.
+	"""
+
+	def __init__(self, db_path):
+		directory = os.path.dirname(db_path)
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+
+		self.conn = sqlite3.connect(db_path, timeout=10, check_same_thread=False)
+		self.conn.row_factory = sqlite3.Row
+		self.conn.execute('PRAGMA journal_mode=WAL')
+		self.conn.executescript(SCHEMA)
+		self.lock = threading.Lock()
+		self.backoff = 0
+		self.retry_at = 0
+
+	def close(self):
+		self.conn.close()
+
+	def record(self, item_id, episode_id, position, duration, is_finished=False):
+		"""Journal the latest position, replacing any pending one for the same media
+
+		Returns the journaled entry, which can be passed to remove() once it is
+		known to have reached the server by other means.
+		"""
+		entry = {
+			'item_id': item_id,
+			'episode_id': episode_id or '',
+			'position': position,
+			'duration': duration,
+			'is_finished': int(is_finished),
+			'recorded_at': time.time()
+		}
+
+		with self.lock, self.conn:
+			self.conn.execute(
+				'INSERT OR REPLACE INTO pending_progress '
+				'(item_id, episode_id, position, duration, is_finished, recorded_at) '
+				'VALUES (:item_id, :episode_id, :position, :duration, :is_finished, :recorded_at)',
+				entry
+			)
+
+		return entry
+
+	def pending(self):
+		"""Get pending updates, oldest first"""
+		with self.lock:
+			rows = self.conn.execute('SELECT * FROM pending_progress ORDER BY recorded_at').fetchall()
+		return [dict(row) for row in rows]
+
+	def remove(self, entries):
+		"""Drop flushed updates unless a newer position was recorded meanwhile"""
+		with self.lock, self.conn:
+			self.conn.executemany(
+				'DELETE FROM pending_progress WHERE item_id = ? AND episode_id = ? AND recorded_at = ?',
+				[(entry['item_id'], entry['episode_id'], entry['recorded_at']) for entry in entries]
+			)
+
+	def flush(self, library_service, force=False, skip=()):
+		"""Send pending updates to the server; returns True if none are left
+
+		Skipped while backing off from an earlier failure unless force is set.
+		skip lists (item_id, episode_id) pairs whose rows are left pending,
+		e.g. the media a playback monitor is syncing itself.
+		"""
+		if not force and time.time() < self.retry_at:
+			return False
+
+		skip = set((item_id, episode_id or '') for item_id, episode_id in skip)
+		entries = [entry for entry in self.pending() if (entry['item_id'], entry['episode_id']) not in skip]
+		if not entries:
+			return True
+
+		# Everything pending goes out in one batch request
+		result = library_service.batch_update_media_progress([
+			{
+				'library_item_id': entry['item_id'],
+				'episode_id': entry['episode_id'] or None,
+				'current_time': entry['position'],
+				'duration': entry['duration'],
+				'is_finished': bool(entry['is_finished'])
+			}
+			for entry in entries
+		])
+
+		if result is None:
+			self._failed()
+			return False
+
+		self.remove(entries)
+
+		self.backoff = 0
+		self.retry_at = 0
+		return True
+
+	def _failed(self):
+		"""Schedule the next flush attempt with exponential backoff"""
+		self.backoff = min(MAX_BACKOFF, self.backoff * 2 or MIN_BACKOFF)
+		self.retry_at = time.time() + self.backoff
+		xbmc.log(f"Progress sync failed, retrying in {self.backoff}s", xbmc.LOGINFO)
@@ -0,0 +1,164 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import xbmc
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlencode
+
+# (path pattern, seconds a response is served without asking the server).
+# The first matching rule applies. A TTL of 0 still caches the body but
+# revalidates it with If-None-Match on every use; a TTL of None, or no
+# matching rule, means the path is never cached.
+DEFAULT_TTLS = (
+	(re.compile(r'^/api/me/progress/'), 0),
+	# Listings are served from the SQLite index; caching every page of a
+	# sync here would only rewrite ever larger groups
+	(re.compile(r'^/api/libraries/[^/]+/items$'), None),
+	(re.compile(r'^/api/libraries'), 60),
+	(re.compile(r'^/api/items/[^/]+$'), 300),
+)
+
+# URL paths whose variants are kept in memory at once
+MEMORY_GROUPS = 64
+
+
+class ResponseCache:
+	"""Two-level (memory, then disk) cache for JSON GET responses
+
+	Entries are grouped per URL path so that a write can invalidate every
+	cached variant of a resource (e.g. all query parameters of one item).
+	"""
+
+	def __init__(self, cache_dir=None, ttls=DEFAULT_TTLS):
+		self.cache_dir = cache_dir
+		self.ttls = ttls
+		# Most recently used groups last
+		self.memory = OrderedDict()
+		self.lock = threading.Lock()
+
+		if cache_dir and not os.path.exists(cache_dir):
+			os.makedirs(cache_dir)
+
+	def ttl_for(self, url):
+		"""Return the TTL for a URL, or None if it must not be cached"""
+		path = urlsplit(url).path
+		for pattern, ttl in self.ttls:
+			if pattern.search(path):
+				return ttl
+		return None
+
+	def _remember(self, url, group):
+		"""Keep a group in memory, forgetting the least recently used beyond the cap"""
+		self.memory[url] = group
+		self.memory.move_to_end(url)
+		while len(self.memory) > MEMORY_GROUPS:
+			self.memory.popitem(last=False)
+
+	@staticmethod
+	def _variant(params):
+		return urlencode(sorted((params or {}).items()))
+
+	def _disk_path(self, url):
+		digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+		return os.path.join(self.cache_dir, f"{digest}.json")
+
+	def _load_group(self, url):
+		"""Get the cached variants of a URL path, reading from disk on a memory miss"""
+		group = self.memory.get(url)
+		if group is not None:
+			self.memory.move_to_end(url)
+			return group
+		if not self.cache_dir:
+			return None
+
+		try:
+			with open(self._disk_path(url), 'r') as f:
+				group = json.load(f)
+		except (OSError, ValueError):
+			return None
+
+		self._remember(url, group)
+		return group
+
+	def _save_group(self, url, group):
+		if not self.cache_dir:
+			return
+
+		path = self._disk_path(url)
+		tmp_path = f"{path}.{threading.get_ident()}.tmp"
+		try:
+			with open(tmp_path, 'w') as f:
+				json.dump(group, f)
+			os.replace(tmp_path, path)
+		except OSError as e:
+			xbmc.log(f"Error writing response cache: {str(e)}", xbmc.LOGDEBUG)
+
+	def get(self, url, params=None):
+		"""Return (body, etag, fresh) for a cached response, or None"""
+		ttl = self.ttl_for(url)
+		if ttl is None:
+			return None
+
+		with self.lock:
+			group = self._load_group(url)
+			entry = group.get(self._variant(params)) if group else None
+
+		if not entry:
+			return None
+
+		fresh = time.time() - entry['fetched_at'] < ttl
+		return entry['body'], entry.get('etag'), fresh
+
+	def put(self, url, params, body, etag=None):
+		"""Store a response if its endpoint is cacheable"""
+		if self.ttl_for(url) is None:
+			return
+
+		with self.lock:
+			group = dict(self._load_group(url) or {})
+			group[self._variant(params)] = {
+				'body': body,
+				'etag': etag,
+				'fetched_at': time.time()
+			}
+			self._remember(url, group)
+			self._save_group(url, group)
+
+	def touch(self, url, params=None):
+		"""Mark a cached response as fresh after a 304 Not Modified"""
+		with self.lock:
+			group = self._load_group(url)
+			entry = group.get(self._variant(params)) if group else None
+			if entry:
+				entry['fetched_at'] = time.time()
+				self._save_group(url, group)
+
+	def invalidate(self, url):
+		"""Drop every cached variant of a URL path"""
+		with self.lock:
+			self.memory.pop(url, None)
+			if self.cache_dir:
+				try:
+					os.remove(self._disk_path(url))
+				except OSError:
+					pass
+
+	def prune(self, max_age):
+		"""Delete on-disk entries not written for max_age seconds and clear memory"""
+		with self.lock:
+			self.memory.clear()
+
+		if not self.cache_dir:
+			return
+
+		cutoff = time.time() - max_age
+		for name in os.listdir(self.cache_dir):
+			path = os.path.join(self.cache_dir, name)
+			try:
+				if os.path.getmtime(path) < cutoff:
+					os.remove(path)
+			except OSError:
+				pass
@@ -0,0 +1,188 @@
+import os
+import time
+import threading
+import xbmc
+import xbmcaddon
+import connection
+from metadata_index import MetadataIndex, LIBRARIES_KEY, sync_libraries, sync_library
+from playback_monitor import PlaybackMonitor
+from timeline import Timeline
+from service_events import PLAY_MESSAGE, set_service_running, set_proxy_port, parse_notification
+
+
+class SyncService(xbmc.Monitor):
+	"""Long-lived service that owns progress sync, playback sessions and cache refresh
+
+	Plugin invocations hand playback over with a play notification and return
+	immediately; the service keeps one pooled connection and auth token for
+	the whole Kodi session.
+	"""
+
+	# Seconds between attempts to replay journaled progress
+	FLUSH_INTERVAL = 30
+
+	def __init__(self):
+		super().__init__()
+		self.addon = xbmcaddon.Addon()
+		self.addon_id = self.addon.getAddonInfo('id')
+		self.library_service = None
+		self.playback = None
+		self.lock = threading.Lock()
+		self.refresh_thread = None
+		self.last_refresh = 0
+		self.progress_queue = connection.get_progress_queue(self.addon)
+		self.last_flush = 0
+		self.stream_proxy = None
+
+	def get_library_service(self):
+		"""Get the service's library service, creating it on first use"""
+		if self.library_service is None:
+			self.library_service = connection.create_library_service(self.addon)
+		return self.library_service
+
+	def onSettingsChanged(self):
+		# Reconnect with the new server settings on next use
+		self.addon = xbmcaddon.Addon()
+		self.library_service = None
+
+	def onNotification(self, sender, method, data):
+		notification = parse_notification(self.addon_id, sender, method, data)
+		if not notification:
+			return
+
+		message, payload = notification
+		if message == PLAY_MESSAGE:
+			try:
+				self._start_playback_monitor(payload)
+			except Exception as e:
+				xbmc.log(f"Error taking over playback: {str(e)}", xbmc.LOGERROR)
+
+	def _start_playback_monitor(self, event):
+		"""Replace the current playback monitor with one for a new play event"""
+		with self.lock:
+			previous, self.playback = self.playback, None
+		if previous:
+			previous.stop_monitoring()
+
+		monitor = PlaybackMonitor(
+			self.get_library_service(), event['item_id'], event.get('duration', 0),
+			episode_id=event.get('episode_id'),
+			sync_kodi_watched=event.get('sync_kodi_watched', False),
+			episode_title=event.get('episode_title'),
+			session_id=event.get('session_id'),
+			url=event.get('url'),
+			file_offset=event.get('file_offset', 0),
+			tracks=event.get('tracks'),
+			timeline=Timeline([], event.get('chapters')),
+			title=event.get('title'),
+			progress_queue=self.progress_queue,
+			min_sync_interval=connection.get_int_setting(self.addon, 'sync_interval_min', 10),
+			max_sync_interval=connection.get_int_setting(self.addon, 'sync_interval_max', 60)
+		)
+		monitor.start_monitoring(event.get('start_position', 0))
+
+		with self.lock:
+			self.playback = monitor
+
+	def _tick_playback(self):
+		with self.lock:
+			monitor = self.playback
+		if monitor and not monitor.tick():
+			monitor.stop_monitoring()
+			with self.lock:
+				if self.playback is monitor:
+					self.playback = None
+
+	def _flush_progress_if_due(self):
+		"""Replay progress journaled while the server was unreachable"""
+		if time.time() - self.last_flush < self.FLUSH_INTERVAL:
+			return
+
+		self.last_flush = time.time()
+
+		# The active monitor journals its position between its own syncs and
+		# flushes it when it syncs; replaying that row here would only add writes
+		with self.lock:
+			monitor = self.playback
+		skip = [(monitor.item_id, monitor.episode_id)] if monitor and monitor.is_monitoring else []
+
+		try:
+			self.progress_queue.flush(self.get_library_service(), skip=skip)
+		except Exception as e:
+			xbmc.log(f"Error flushing progress: {str(e)}", xbmc.LOGDEBUG)
+
+	def _refresh_caches_if_due(self):
+		"""Start a background index refresh every index sync interval"""
+		interval = connection.get_int_setting(self.addon, 'index_sync_interval', 5) * 60
+		if time.time() - self.last_refresh < interval:
+			return
+		if self.refresh_thread and self.refresh_thread.is_alive():
+			return
+
+		self.last_refresh = time.time()
+		self.refresh_thread = threading.Thread(target=self._refresh_caches)
+		self.refresh_thread.daemon = True
+		self.refresh_thread.start()
+
+	def _refresh_caches(self):
+		"""Sync the library index and prune the response cache"""
+		index = None
+		try:
+			library_service = self.get_library_service()
+			index = MetadataIndex(os.path.join(connection.get_profile_path(self.addon), 'library.db'))
+			page_size = connection.get_int_setting(self.addon, 'page_size', 100)
+
+			# Only refresh what has been browsed at least once
+			if index.is_synced(LIBRARIES_KEY):
+				for library in sync_libraries(index, library_service):
+					if self.abortRequested():
+						break
+					if index.is_synced(library['id']):
+						sync_library(index, library_service, library['id'], page_size)
+
+			if library_service.cache:
+				library_service.cache.prune(7 * 24 * 3600)
+		except Exception as e:
+			xbmc.log(f"Background cache refresh failed: {str(e)}", xbmc.LOGINFO)
+		finally:
+			if index:
+				index.close()
+
+	def _start_stream_proxy(self):
+		"""Start the caching stream proxy if enabled and advertise its port"""
+		try:
+			self.stream_proxy = connection.create_stream_proxy(self.addon, self.get_library_service)
+			if self.stream_proxy:
+				self.stream_proxy.start()
+				set_proxy_port(self.stream_proxy.port)
+		except Exception as e:
+			xbmc.log(f"Could not start stream proxy: {str(e)}", xbmc.LOGERROR)
+			self.stream_proxy = None
+
+	def run(self):
+		"""Run until Kodi shuts down"""
+		xbmc.log("Audiobookshelf service started", xbmc.LOGINFO)
+		set_service_running(True)
+		self._start_stream_proxy()
+
+		try:
+			while not self.waitForAbort(PlaybackMonitor.POLL_INTERVAL):
+				self._tick_playback()
+				self._flush_progress_if_due()
+				self._refresh_caches_if_due()
+		finally:
+			set_service_running(False)
+			set_proxy_port(None)
+			if self.stream_proxy:
+				self.stream_proxy.stop()
+			with self.lock:
+				monitor, self.playback = self.playback, None
+			if monitor:
+				monitor.stop_monitoring()
+			self.progress_queue.close()
+
+		xbmc.log("Audiobookshelf service stopped", xbmc.LOGINFO)
+
+
+if __name__ == '__main__':
+	SyncService().run()
@@ -0,0 +1,68 @@
+import json
+import xbmc
+import xbmcgui
+
+# Home window property set while the background service is running
+SERVICE_RUNNING_PROPERTY = 'audiobookshelf.service.running'
+PLAY_MESSAGE = 'play'
+# Home window property holding the stream proxy's port while it runs
+PROXY_PORT_PROPERTY = 'audiobookshelf.proxy.port'
+
+HOME_WINDOW_ID = 10000
+
+
+def set_service_running(running):
+	"""Advertise to plugin invocations whether the service is up"""
+	window = xbmcgui.Window(HOME_WINDOW_ID)
+	if running:
+		window.setProperty(SERVICE_RUNNING_PROPERTY, 'true')
+	else:
+		window.clearProperty(SERVICE_RUNNING_PROPERTY)
+
+
+def is_service_running():
+	return xbmcgui.Window(HOME_WINDOW_ID).getProperty(SERVICE_RUNNING_PROPERTY) == 'true'
+
+
+def set_proxy_port(port):
+	"""Advertise the stream proxy's port, or None once it has stopped"""
+	window = xbmcgui.Window(HOME_WINDOW_ID)
+	if port:
+		window.setProperty(PROXY_PORT_PROPERTY, str(port))
+	else:
+		window.clearProperty(PROXY_PORT_PROPERTY)
+
+
+def get_proxy_port():
+	"""Port of the running stream proxy, or None"""
+	port = xbmcgui.Window(HOME_WINDOW_ID).getProperty(PROXY_PORT_PROPERTY)
+	return int(port) if port else None
+
+
+def notify_service(addon_id, message, data):
+	"""Send a message to the service's xbmc.Monitor.onNotification"""
+	request = {
+		"jsonrpc": "2.0",
+		"method": "JSONRPC.NotifyAll",
+		"params": {
+			"sender": addon_id,
+			"message": message,
+			"data": data
+		},
+		"id": 1
+	}
+	xbmc.executeJSONRPC(json.dumps(request))
+
+
+def parse_notification(addon_id, sender, method, data):
+	"""Return (message, data) for a notification sent by notify_service, else None"""
+	if sender != addon_id or not method.startswith('Other.'):
+		return None
+
+	try:
+		payload = json.loads(data) if data else {}
+	except ValueError:
+		xbmc.log(f"Ignoring malformed notification data: {data}", xbmc.LOGDEBUG)
+		return None
+
+	return method[len('Other.'):], payload
@@ -0,0 +1,366 @@
+import os
+import re
+import json
+import hashlib
+import threading
+import xbmc
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Audio is fetched from the server and cached in pieces of this size
+CHUNK_SIZE = 1024 * 1024
+# Chunks fetched ahead of the one being played
+READ_AHEAD = 4
+# Seconds to wait for a chunk another thread is already fetching
+FETCH_WAIT = 30
+
+PROXIED_PATH = re.compile(r'^/api/items/[^/]+/file/[^/?]+$')
+
+
+class ChunkCache:
+	"""Fixed-size pieces of audio files on disk, evicted least recently used first"""
+
+	def __init__(self, cache_dir, max_bytes):
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+		self.lock = threading.Lock()
+
+		if not os.path.exists(cache_dir):
+			os.makedirs(cache_dir)
+
+		# Oldest first; file modification time stands in for last use across restarts
+		self.entries = OrderedDict()
+		names = [name for name in os.listdir(cache_dir) if name.endswith('.chunk')]
+		for name in sorted(names, key=lambda name: self._mtime(name)):
+			try:
+				self.entries[name] = os.path.getsize(os.path.join(cache_dir, name))
+			except OSError:
+				pass
+		self.total_bytes = sum(self.entries.values())
+
+	def _mtime(self, name):
+		try:
+			return os.path.getmtime(os.path.join(self.cache_dir, name))
+		except OSError:
+			return 0
+
+	def has(self, key, number):
+		with self.lock:
+			return f"{key}_{number}.chunk" in self.entries
+
+	def get(self, key, number):
+		"""Return a cached chunk, or None"""
+		name = f"{key}_{number}.chunk"
+		with self.lock:
+			if name not in self.entries:
+				return None
+			self.entries.move_to_end(name)
+
+		path = os.path.join(self.cache_dir, name)
+		try:
+			with open(path, 'rb') as f:
+				data = f.read()
+			os.utime(path)
+			return data
+		except OSError:
+			with self.lock:
+				self.total_bytes -= self.entries.pop(name, 0)
+			return None
+
+	def put(self, key, number, data):
+		"""Atomically store a chunk and evict old ones beyond the byte budget"""
+		name = f"{key}_{number}.chunk"
+		path = os.path.join(self.cache_dir, name)
+		tmp_path = f"{path}.{threading.get_ident()}.part"
+
+		try:
+			with open(tmp_path, 'wb') as f:
+				f.write(data)
+			os.replace(tmp_path, path)
+		except OSError as e:
+			xbmc.log(f"Error caching audio chunk: {str(e)}", xbmc.LOGDEBUG)
+			return
+
+		with self.lock:
+			self.total_bytes += len(data) - self.entries.pop(name, 0)
+			self.entries[name] = len(data)
+			while self.max_bytes > 0 and self.total_bytes > self.max_bytes and len(self.entries) > 1:
+				old_name, size = self.entries.popitem(last=False)
+				self.total_bytes -= size
+				try:
+					os.remove(os.path.join(self.cache_dir, old_name))
+				except OSError:
+					pass
+
+	def get_meta(self, key):
+		"""Return the stored size and content type of a file, or None"""
+		try:
+			with open(os.path.join(self.cache_dir, f"{key}.json"), 'r') as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return None
+
+	def put_meta(self, key, meta):
+		try:
+			with open(os.path.join(self.cache_dir, f"{key}.json"), 'w') as f:
+				json.dump(meta, f)
+		except OSError as e:
+			xbmc.log(f"Error caching audio file info: {str(e)}", xbmc.LOGDEBUG)
+
+
+class StreamProxy:
+	"""Local HTTP server that serves audio files from a chunk cache
+
+	Kodi requests /api/items/<id>/file/<ino> from the proxy instead of the
+	server. Byte ranges are served from cached chunks; missing chunks are
+	fetched with Range requests, and the chunks following the one being read
+	are prefetched in the background so seeks into already heard or just
+	buffered audio never wait for the network.
+
+	get_library_service() returns the current library service; its base URL
+	and token authenticate upstream requests, and a rejected token is
+	refreshed through it.
+	"""
+
+	def __init__(self, cache, session, get_library_service, max_workers=2):
+		self.cache = cache
+		self.session = session
+		self.get_library_service = get_library_service
+		self.lock = threading.Lock()
+		self.inflight = {}
+		self.meta = {}
+		self.pool = ThreadPoolExecutor(max_workers=max_workers)
+		self.server = None
+		self.thread = None
+
+	@property
+	def port(self):
+		return self.server.server_address[1] if self.server else None
+
+	def start(self, port=0):
+		"""Start serving on localhost; port 0 picks a free one"""
+		self.server = ThreadingHTTPServer(('127.0.0.1', port), ProxyRequestHandler)
+		self.server.daemon_threads = True
+		self.server.proxy = self
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+		xbmc.log(f"Stream proxy listening on port {self.port}", xbmc.LOGINFO)
+
+	def stop(self):
+		if self.server:
+			self.server.shutdown()
+			self.server.server_close()
+			self.server = None
+		self.pool.shutdown(wait=False)
+
+	def file_info(self, key, path):
+		"""Return {'size', 'type'} of a file, fetching its first chunk if unknown"""
+		meta = self.meta.get(key) or self.cache.get_meta(key)
+		if meta is None:
+			self._fetch(key, path, 0)
+			meta = self.meta.get(key)
+		else:
+			self.meta[key] = meta
+		return meta
+
+	def chunk(self, key, path, number):
+		"""Return a chunk from the cache, fetching it unless another thread already is"""
+		data = self.cache.get(key, number)
+		if data is not None:
+			return data
+
+		with self.lock:
+			event = self.inflight.get((key, number))
+			owner = event is None
+			if owner:
+				event = self.inflight[(key, number)] = threading.Event()
+
+		if not owner:
+			event.wait(FETCH_WAIT)
+			data = self.cache.get(key, number)
+			if data is not None:
+				return data
+
+		try:
+			return self._fetch(key, path, number)
+		finally:
+			if owner:
+				with self.lock:
+					self.inflight.pop((key, number), None)
+				event.set()
+
+	def read_ahead(self, key, path, number, size):
+		"""Prefetch the chunks after number in the background"""
+		last = (size - 1) // CHUNK_SIZE
+		for ahead in range(number + 1, min(number + READ_AHEAD, last) + 1):
+			with self.lock:
+				busy = (key, ahead) in self.inflight
+			if not busy and not self.cache.has(key, ahead):
+				self.pool.submit(self._prefetch, key, path, ahead)
+
+	def _prefetch(self, key, path, number):
+		try:
+			self.chunk(key, path, number)
+		except Exception as e:
+			xbmc.log(f"Audio read-ahead failed: {str(e)}", xbmc.LOGDEBUG)
+
+	def _get_upstream(self, path, headers):
+		"""GET a path from the server, logging in again once if the token was rejected"""
+		library_service = self.get_library_service()
+		token = library_service.token
+		response = self.session.get(f"{library_service.base_url}{path}?token={token}", headers=headers)
+
+		if response.status_code == 401 and library_service.refresh_token(token):
+			response = self.session.get(f"{library_service.base_url}{path}?token={library_service.token}", headers=headers)
+
+		return response
+
+	def _fetch(self, key, path, number):
+		"""Fetch one chunk from the server and cache it"""
+		start = number * CHUNK_SIZE
+		headers = {'Range': f'bytes={start}-{start + CHUNK_SIZE - 1}'}
+		response = self._get_upstream(path, headers)
+		if response.status_code == 416:
+			# Past the end of the file; for the first chunk the file is empty
+			if number == 0 and key not in self.meta:
+				self._remember_meta(key, {'size': 0, 'type': 'application/octet-stream'})
+			return b''
+		response.raise_for_status()
+
+		if response.status_code == 206:
+			data = response.content
+			# Content-Range: bytes <start>-<end>/<size>
+			size = int(response.headers.get('Content-Range', '').rsplit('/', 1)[-1])
+		else:
+			# The server ignored the range and sent the whole file
+			data = response.content[start:start + CHUNK_SIZE]
+			size = len(response.content)
+
+		if key not in self.meta:
+			self._remember_meta(key, {'size': size, 'type': response.headers.get('Content-Type', 'application/octet-stream')})
+
+		self.cache.put(key, number, data)
+		return data
+
+	def _remember_meta(self, key, meta):
+		self.meta[key] = meta
+		self.cache.put_meta(key, meta)
+
+
+class ProxyRequestHandler(BaseHTTPRequestHandler):
+	"""Serve GET and HEAD with byte ranges for proxied audio files"""
+
+	protocol_version = 'HTTP/1.1'
+
+	def do_HEAD(self):
+		self._serve(send_body=False)
+
+	def do_GET(self):
+		self._serve(send_body=True)
+
+	def _serve(self, send_body):
+		proxy = self.server.proxy
+		path = self.path.split('?', 1)[0]
+		if not PROXIED_PATH.match(path):
+			self.send_error(404)
+			return
+
+		key = hashlib.sha1(path.encode('utf-8')).hexdigest()
+		try:
+			info = proxy.file_info(key, path)
+		except Exception as e:
+			xbmc.log(f"Stream proxy could not reach the server: {str(e)}", xbmc.LOGERROR)
+			self.send_error(502)
+			return
+		if info is None:
+			self.send_error(502)
+			return
+
+		size = info['size']
+		if not size and not self.headers.get('Range'):
+			# An empty file has no satisfiable range, but a plain request gets it whole
+			self.send_response(200)
+			self.send_header('Content-Type', info['type'])
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+
+		byte_range = _parse_range(self.headers.get('Range'), size)
+		if byte_range is None:
+			self.send_response(416)
+			self.send_header('Content-Range', f'bytes */{size}')
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+
+		start, end = byte_range
+		if self.headers.get('Range'):
+			self.send_response(206)
+			self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+		else:
+			self.send_response(200)
+		self.send_header('Content-Type', info['type'])
+		self.send_header('Accept-Ranges', 'bytes')
+		self.send_header('Content-Length', str(end - start + 1))
+		self.end_headers()
+
+		if not send_body:
+			return
+
+		try:
+			position = start
+			while position <= end:
+				number = position // CHUNK_SIZE
+				proxy.read_ahead(key, path, number, size)
+				data = proxy.chunk(key, path, number)
+				if not data:
+					break
+				offset = position - number * CHUNK_SIZE
+				piece = data[offset:offset + end - position + 1]
+				self.wfile.write(piece)
+				position += len(piece)
+		except (BrokenPipeError, ConnectionResetError):
+			# Kodi closes the connection whenever it seeks
+			pass
+		except Exception as e:
+			xbmc.log(f"Stream proxy error: {str(e)}", xbmc.LOGERROR)
+			self.close_connection = True
+
+	def log_message(self, format, *args):
+		xbmc.log(f"Stream proxy: {format % args}", xbmc.LOGDEBUG)
+
+
+def _parse_range(header, size):
+	"""Return (start, end) for a Range header, the whole file if absent, or None"""
+	if not header:
+		return (0, size - 1) if size else None
+
+	match = re.match(r'bytes=(\d*)-(\d*)$', header.strip())
+	if not match or not (match.group(1) or match.group(2)):
+		return None
+
+	if match.group(1):
+		start = int(match.group(1))
+		end = int(match.group(2)) if match.group(2) else size - 1
+	else:
+		# Suffix range: the last N bytes
+		start = max(0, size - int(match.group(2)))
+		end = size - 1
+
+	end = min(end, size - 1)
+	if start > end:
+		return None
+	return start, end
+
+
+def proxy_url(url, base_url, port):
+	"""Route a direct file URL of the server through the proxy; other URLs are kept"""
+	if not url.startswith(base_url):
+		return url
+
+	path = url[len(base_url):].split('?', 1)[0]
+	if not PROXIED_PATH.match(path):
+		return url
+	return f"http://127.0.0.1:{port}{path}"
@@ -0,0 +1,63 @@
+import bisect
+
+
+class Timeline:
+	"""Map between file-relative and absolute positions of a multi-file book
+
+	Start offsets of the audio files and chapters are precomputed once, so
+	finding the file or chapter containing a position is a bisect lookup.
+	"""
+
+	def __init__(self, audio_files, chapters=None):
+		self.files = sorted(audio_files, key=lambda x: x.get('index', 0))
+		self.offsets = []
+
+		cumulative = 0
+		for f in self.files:
+			self.offsets.append(cumulative)
+			cumulative += f.get('duration', 0) or 0
+		self.duration = cumulative
+
+		self.chapters = sorted(chapters or [], key=lambda x: x.get('start', 0))
+		self.chapter_starts = [c.get('start', 0) for c in self.chapters]
+
+	def __len__(self):
+		return len(self.files)
+
+	def file_offset(self, file_index):
+		"""Absolute start of a file"""
+		return self.offsets[file_index]
+
+	def index_of(self, ino):
+		"""Index of the file with this inode, or None"""
+		for i, f in enumerate(self.files):
+			if f.get('ino') == ino:
+				return i
+		return None
+
+	def to_absolute(self, file_index, position):
+		"""Convert a position within a file to a position within the book"""
+		return self.offsets[file_index] + position
+
+	def locate(self, position):
+		"""Return (file index, position within that file) for a book position"""
+		if not self.files:
+			raise ValueError("Could not find audio file")
+
+		file_index = self.file_at(position)
+		return file_index, position - self.offsets[file_index]
+
+	def file_at(self, position):
+		"""Index of the file containing a book position"""
+		return max(0, bisect.bisect_right(self.offsets, position) - 1)
+
+	def chapter_at(self, position):
+		"""Index of the chapter containing a book position, or None before the first"""
+		index = bisect.bisect_right(self.chapter_starts, position) - 1
+		return index if index >= 0 else None
+
+
+def get_timeline(item):
+	"""Build the timeline of a fetched item"""
+	media = item.get('media', {})
+	return Timeline(media.get('audioFiles', []), media.get('chapters', []))
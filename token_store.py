@@ -0,0 +1,51 @@
+import os
+import json
+import xbmc
+
+
+class TokenStore:
+	"""Persist the last Audiobookshelf auth token in the addon profile"""
+
+	def __init__(self, profile_path, filename='token.json'):
+		self.path = os.path.join(profile_path, filename)
+
+	def load(self, base_url, username):
+		"""Return the stored token for this server and user, or None"""
+		try:
+			with open(self.path, 'r') as f:
+				data = json.load(f)
+		except (OSError, ValueError):
+			return None
+
+		# Only reuse a token issued for the currently configured account
+		if data.get('url') != base_url or data.get('username') != username:
+			return None
+
+		return data.get('token')
+
+	def save(self, base_url, username, token):
+		"""Store a token for this server and user"""
+		data = {
+			'url': base_url,
+			'username': username,
+			'token': token
+		}
+
+		try:
+			directory = os.path.dirname(self.path)
+			if not os.path.exists(directory):
+				os.makedirs(directory)
+
+			tmp_path = self.path + '.tmp'
+			with open(tmp_path, 'w') as f:
+				json.dump(data, f)
+			os.replace(tmp_path, self.path)
+		except OSError as e:
+			xbmc.log(f"Error saving auth token: {str(e)}", xbmc.LOGERROR)
+
+	def clear(self):
+		"""Forget the stored token"""
+		try:
+			os.remove(self.path)
+		except OSError:
+			pass